@@ -0,0 +1,192 @@
+"""Lightweight stand-ins for the discord objects the sync cogs touch.
+
+Only the attributes and methods the cogs actually use are implemented.
+Role edits are recorded instead of being sent anywhere and are applied
+to the fake member immediately, the same way the gateway update would.
+"""
+import asyncio
+import random
+
+import discord
+
+from ghist.role_applier import RoleApplier
+from ghist.role_index import RoleMemberIndex
+from ghist.role_registry import RoleRegistry
+from ghist.scheduler import Scheduler
+
+
+class FakeRole:
+    def __init__(self, role_id, name, guild, color=0):
+        self.id = role_id
+        self.name = name
+        self.guild = guild
+        self.color = discord.Colour(color)
+
+    def is_default(self):
+        return self.id == self.guild.id
+
+    def __repr__(self):
+        return f"<FakeRole {self.name!r}>"
+
+
+class FakeMember:
+    def __init__(self, member_id, guild, role_ids):
+        self.id = member_id
+        self.name = f"member-{member_id}"
+        self.guild = guild
+        self._role_ids = set(role_ids)
+
+    @property
+    def roles(self):
+        roles = [self.guild.default_role]
+        roles.extend(self.guild.get_role(role_id) for role_id in self._role_ids)
+        return roles
+
+    def get_role(self, role_id):
+        if role_id in self._role_ids:
+            return self.guild.get_role(role_id)
+
+    def _copy(self):
+        return FakeMember(self.id, self.guild, self._role_ids)
+
+    async def edit(self, *, roles, reason=None):
+        before = self._copy()
+        self._role_ids = {role.id for role in roles}
+        self.guild.recorder.record(self, before)
+
+
+class EditRecorder:
+    """Counts role mutations and replays them into the bot's role index."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.edits = 0
+        self.added = 0
+        self.removed = 0
+
+    def reset(self):
+        self.edits = self.added = self.removed = 0
+
+    def record(self, member, before):
+        self.edits += 1
+        self.added += len(member._role_ids - before._role_ids)
+        self.removed += len(before._role_ids - member._role_ids)
+        self.bot.role_index.update_member(before, member)
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self._roles = {}
+        self._members = {}
+        self.recorder = None
+        self.default_role = self.add_role("@everyone", role_id=guild_id)
+
+    def add_role(self, name, role_id=None, color=0):
+        if role_id is None:
+            role_id = self.id + len(self._roles) + 1
+        role = FakeRole(role_id, name, self, color)
+        self._roles[role.id] = role
+        return role
+
+    def add_member(self, member_id, role_ids=()):
+        member = FakeMember(member_id, self, role_ids)
+        self._members[member_id] = member
+        return member
+
+    @property
+    def roles(self):
+        return list(self._roles.values())
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def get_role(self, role_id):
+        return self._roles.get(role_id)
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+
+class FakeBot:
+    def __init__(self, mossranking=None):
+        self.mossranking = mossranking
+        self.snapshot = None
+        self.member_fetcher = None
+        self.plan_recorder = None
+        # Unthrottled so the benchmark measures our own overhead.
+        self.role_applier = RoleApplier(concurrency=8, rate=10 ** 9, per=1.0)
+        self.role_index = RoleMemberIndex()
+        self.role_registry = RoleRegistry()
+        self.scheduler = Scheduler(self.wait_until_ready)
+        self._guilds = {}
+        self._cogs = {}
+        self._ready = asyncio.Event()
+
+    @property
+    def guilds(self):
+        return list(self._guilds.values())
+
+    def add_guild(self, guild):
+        guild.recorder = EditRecorder(self)
+        self._guilds[guild.id] = guild
+
+    def get_guild(self, guild_id):
+        return self._guilds.get(guild_id)
+
+    def add_cog(self, cog):
+        self._cogs[type(cog).__name__] = cog
+
+    def get_cog(self, name):
+        return self._cogs.get(name)
+
+    async def wait_until_ready(self):
+        # Keeps the cogs' scheduled jobs idle, the benchmark drives syncs.
+        await self._ready.wait()
+
+
+def make_guild(
+    num_members,
+    games,
+    rankings,
+    mr_fraction=0.1,
+    synced_fraction=0.0,
+    extra_roles=20,
+    seed=0,
+):
+    """Build a guild with Mossranking roles and a random member population.
+
+    `games` maps Mossranking game names to the name of their sync role and
+    `rankings` lists the badge role names. `mr_fraction` of the members
+    are linked on Mossranking and
+    `synced_fraction` of those already hold the roles a previous sync
+    would have given them. Every member also gets a few unrelated roles.
+    """
+    rng = random.Random(seed)
+    guild = FakeGuild(1 << 40)
+
+    mr_role = guild.add_role("Mossranking")
+    game_roles = {game: guild.add_role(role_name) for game, role_name in games.items()}
+    ranking_roles = [guild.add_role(name) for name in rankings]
+    other_roles = [guild.add_role(f"Other {idx}") for idx in range(extra_roles)]
+
+    mr_users = {}
+    for idx in range(num_members):
+        member_id = (1 << 41) + idx
+        role_ids = {role.id for role in rng.sample(other_roles, k=min(3, extra_roles))}
+
+        if rng.random() < mr_fraction:
+            user_games = {game for game in games if rng.random() < 0.5}
+            mr_users[member_id] = user_games
+            if rng.random() < synced_fraction:
+                role_ids.add(mr_role.id)
+                role_ids.update(game_roles[game].id for game in user_games)
+        elif rng.random() < 0.001:
+            # A stale role left over from someone who unlinked their account.
+            role_ids.add(rng.choice(ranking_roles).id)
+
+        guild.add_member(member_id, role_ids)
+
+    return guild, mr_role, game_roles, mr_users
@@ -0,0 +1,110 @@
+"""Offline benchmark for the `!color` palette image.
+
+Renders palettes of synthetic color roles and encodes each one as a plain
+RGBA PNG (the old encoding), a palette PNG and a lossless WebP, reporting
+the encode time and size of each and checking that every swatch decodes to
+its exact role color.
+
+Usage:
+    python -m bench.palette_bench --colors 10 25 50 100 200
+"""
+import argparse
+import io
+import random
+import statistics
+import time
+
+from PIL import Image
+
+from ghist.cogs.color import (
+    PNG_FORMAT,
+    WEBP_FORMAT,
+    draw_available_colors,
+    encode_image,
+    get_layout,
+)
+
+
+def encode_rgba_png(img, swatches):  # pylint: disable=unused-argument
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf
+
+
+ENCODERS = {
+    "rgba-png": encode_rgba_png,
+    "palette-png": lambda img, swatches: encode_image(img, swatches, PNG_FORMAT)[0],
+    "lossless-webp": lambda img, swatches: encode_image(img, swatches, WEBP_FORMAT)[0],
+}
+
+
+def make_colors(num_colors, seed=0):
+    rng = random.Random(seed)
+    return {
+        f"Color: Shade {idx:03}": (
+            rng.randrange(256),
+            rng.randrange(256),
+            rng.randrange(256),
+        )
+        for idx in range(num_colors)
+    }
+
+
+def count_wrong_swatches(img, colors, buf):
+    """Count role colors with a pixel that doesn't decode to that exact color."""
+    swatches = {rgb + (255,) for rgb in colors.values()}
+    decoded = Image.open(buf).convert("RGBA")
+    wrong = set()
+    for drawn, got in zip(img.getdata(), decoded.getdata()):
+        if drawn in swatches and got != drawn:
+            wrong.add(drawn)
+    return len(wrong)
+
+
+def run(num_colors, repeat):
+    colors = make_colors(num_colors)
+    size, swatches = get_layout(colors)
+    img = draw_available_colors(size, swatches)
+    results = []
+    for name, encode in ENCODERS.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            buf = encode(img, swatches)
+            timings.append(time.perf_counter() - start)
+        results.append(
+            {
+                "colors": num_colors,
+                "encoding": name,
+                "median_ms": round(statistics.median(timings) * 1000, 2),
+                "bytes": len(buf.getvalue()),
+                "wrong": count_wrong_swatches(img, colors, buf),
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--colors",
+        type=int,
+        nargs="+",
+        default=[10, 25, 50, 100, 200],
+        help="Numbers of color roles to render.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Times to encode each palette."
+    )
+    args = parser.parse_args()
+
+    for num_colors in args.colors:
+        for result in run(num_colors, args.repeat):
+            print(
+                "{colors:>4} colors  {encoding:<14} {median_ms:>8}ms "
+                "{bytes:>9} bytes {wrong:>4} wrong swatches".format(**result)
+            )
+
+
+if __name__ == "__main__":
+    main()
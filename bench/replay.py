@@ -0,0 +1,140 @@
+"""Replay recorded Mossranking sync inputs through the role planners.
+
+Recordings are written by the bot when `mr-sync.record-dir` is configured.
+Each one holds the payload, the managed roles of the members that were
+planned and the plan the bot made. Replaying re-plans the same members,
+times the planner and reports any members whose plan differs from the
+recorded one.
+
+Usage:
+    python -m bench.replay plans/*.json --repeat 20
+"""
+import argparse
+import json
+import statistics
+import time
+
+from ghist.cogs.sync_ranking_icons import GAMES
+from ghist.planner import (
+    load_recording,
+    plan_badge_member,
+    plan_members,
+    plan_mossranking_member,
+)
+
+GAMES_BY_RANKING = {game.ranking_id: game for game in GAMES}
+
+
+def get_member_roles(recording):
+    return {
+        int(member_id): frozenset(role_ids)
+        for member_id, role_ids in recording["members"].items()
+    }
+
+
+def get_mossranking_planner(recording):
+    payload = {
+        int(member_id): games for member_id, games in recording["payload"].items()
+    }
+    game_role_bits = {
+        int(role_id): bit for role_id, bit in recording["game_role_bits"].items()
+    }
+
+    def plan_member(member_id, held):
+        return plan_mossranking_member(
+            member_id,
+            held,
+            payload.get(member_id),
+            recording["role_id"],
+            game_role_bits,
+        )
+
+    return plan_member
+
+
+def get_badge_planner(recording):
+    payload = {
+        int(member_id): title for member_id, title in recording["payload"].items()
+    }
+    game = GAMES_BY_RANKING[recording["ranking_id"]]
+
+    def plan_member(member_id, held):
+        return plan_badge_member(
+            member_id,
+            held,
+            payload.get(member_id),
+            recording["sync_role_id"],
+            recording["ranking_role_ids"],
+            game.matcher.match,
+        )
+
+    return plan_member
+
+
+PLANNERS = {
+    "mr-sync": get_mossranking_planner,
+    "icon-sync": get_badge_planner,
+}
+
+
+def replay(path, repeat):
+    recording = load_recording(path)
+    plan_member = PLANNERS[recording["sync"]](recording)
+    member_roles = get_member_roles(recording)
+    member_ids = recording["member_ids"]
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        plans, absent_ids = plan_members(member_roles, member_ids, plan_member)
+        timings.append(time.perf_counter() - start)
+
+    recorded = {plan["member_id"]: plan for plan in recording["plan"]}
+    replayed = {plan.member_id: plan.to_dict() for plan in plans}
+    differing = sorted(
+        member_id
+        for member_id in recorded.keys() | replayed.keys()
+        if recorded.get(member_id) != replayed.get(member_id)
+    )
+
+    return {
+        "recording": str(path),
+        "sync": recording["sync"],
+        "planned": len(plans),
+        "absent": len(absent_ids),
+        "mutations": sum(1 for plan in plans if plan.add or plan.remove),
+        "median_ms": round(statistics.median(timings) * 1000, 3),
+        "differing": differing,
+        "plan": list(replayed.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recordings", nargs="+", help="Recorded sync inputs.")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Times to run each planner."
+    )
+    parser.add_argument("--output", help="Write the replayed plans to this file.")
+    args = parser.parse_args()
+
+    results = [replay(path, args.repeat) for path in args.recordings]
+
+    for result in results:
+        print(
+            "{recording}: {sync} planned {planned} members ({absent} absent), "
+            "{mutations} mutations in {median_ms}ms, "
+            "{num_differing} differ from the recording".format(
+                num_differing=len(result["differing"]), **result
+            )
+        )
+        for member_id in result["differing"][:10]:
+            print(f"  member {member_id}")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
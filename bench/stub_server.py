@@ -0,0 +1,123 @@
+"""Local stand-in for the Mossranking api used by the benchmarks.
+
+Payloads are generated up front and served pre-encoded from a background
+thread with its own event loop so serving them doesn't show up in the
+CPU time measured for the sync under test. With `etags` enabled the stub
+answers conditional requests like a server that supports them would.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import threading
+
+from aiohttp import web
+
+
+def make_users_payload(mr_users, games):
+    payload = []
+    for idx, (discord_id, user_games) in enumerate(mr_users.items()):
+        record = {
+            "mossranking[id_user]": str(idx + 1),
+            "mossranking[username]": f"mr-user-{idx}",
+            "discord[id]": str(discord_id),
+            "discord[username]": f"member-{discord_id}",
+        }
+        for game in games:
+            record[f"games[{game}]"] = game in user_games
+        payload.append(record)
+    return payload
+
+
+def make_ranking_payloads(mr_users, ranking_games, seed=0):
+    """Build getdiscorduserranking payloads keyed by ranking id.
+
+    `ranking_games` maps a Mossranking game name to its ranking `Game`.
+    """
+    rng = random.Random(seed)
+    payloads = {}
+    for game_name, game in ranking_games.items():
+        titles = {}
+        for discord_id, user_games in mr_users.items():
+            if game_name not in user_games:
+                continue
+            ranking = rng.choice(game.rankings)
+            needle = ranking.contains
+            if not isinstance(needle, str):
+                needle = needle[0]
+            titles[str(discord_id)] = f"{needle} Explorer"
+        payloads[game.ranking_id] = titles
+    return payloads
+
+
+class StubMossrankingServer:
+    def __init__(
+        self, users_payload, ranking_payloads, host="127.0.0.1", port=0, etags=True
+    ):
+        self.host = host
+        self.port = port
+        self.etags = etags
+        self.requests = 0
+        self._users = json.dumps(users_payload).encode()
+        self._rankings = {
+            str(ranking_id): json.dumps(payload).encode()
+            for ranking_id, payload in ranking_payloads.items()
+        }
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/"
+
+    def _respond(self, request, body):
+        if not self.etags:
+            return web.Response(body=body, content_type="application/json")
+
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(
+            body=body, content_type="application/json", headers={"ETag": etag}
+        )
+
+    async def get_users(self, request):
+        self.requests += 1
+        return self._respond(request, self._users)
+
+    async def get_ranking(self, request):
+        self.requests += 1
+        body = self._rankings.get(request.query.get("id_ranking"))
+        if body is None:
+            return web.Response(status=404)
+        return self._respond(request, body)
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get("/getdiscordusers.php", self.get_users)
+        app.router.add_get("/getdiscorduserranking.php", self.get_ranking)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="stub-mossranking", daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        future = asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop)
+        future.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
@@ -0,0 +1,222 @@
+"""Offline benchmark for the Mossranking role-sync cogs.
+
+Builds synthetic guilds, serves matching payloads from a local stub of
+the Mossranking api and runs each sync twice: once cold, where most
+members still need their roles, and once steady, where nothing changed.
+
+Usage:
+    python -m bench.sync_bench --members 10000 50000 200000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+import tracemalloc
+
+from bench.fakes import FakeBot, make_guild
+from bench.stub_server import (
+    StubMossrankingServer,
+    make_ranking_payloads,
+    make_users_payload,
+)
+from ghist.cogs.mr_sync import MossrankingGuild, MossrankingSync
+from ghist.cogs.sync_ranking_icons import GAMES, MossRankingIconSync
+from ghist.mossranking import MossrankingClient
+
+# Mossranking game names and the ranking they map to for badge syncing.
+MR_GAMES = {
+    "Spelunky Classic": GAMES[0],
+    "Spelunky HD": GAMES[1],
+    "Spelunky 2": GAMES[2],
+    "Roguelike Challenges": None,
+}
+
+
+def get_bench_games():
+    games = {}
+    for game_name, game in MR_GAMES.items():
+        games[game_name] = game.role if game else f"Badge: MR-Sync {game_name}"
+    return games
+
+
+def get_ranking_role_names():
+    return [ranking.role for game in GAMES for ranking in game.rankings]
+
+
+async def measure(name, recorder, coro_fn, trace_memory):
+    recorder.reset()
+    if trace_memory:
+        tracemalloc.reset_peak()
+        mem_before = tracemalloc.get_traced_memory()[0]
+
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    await coro_fn()
+    cpu = time.thread_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] - mem_before
+
+    return {
+        "scenario": name,
+        "wall_s": round(wall, 4),
+        "cpu_s": round(cpu, 4),
+        "peak_mem_kib": None if peak is None else peak // 1024,
+        "edits": recorder.edits,
+        "roles_added": recorder.added,
+        "roles_removed": recorder.removed,
+    }
+
+
+async def run_syncs(guild, mr_role, game_roles, base_url, args):
+    client = MossrankingClient(key="bench", base_url=base_url)
+    bot = FakeBot(mossranking=client)
+    bot.add_guild(guild)
+
+    mr_guild = MossrankingGuild(
+        guild_id=guild.id,
+        role_id=mr_role.id,
+        game_role_ids={game: role.id for game, role in game_roles.items()},
+    )
+    mr_sync = MossrankingSync(bot=bot, guilds=[mr_guild])
+    icon_sync = MossRankingIconSync(bot=bot, guild_ids=[guild.id])
+    if args.unified:
+        bot.add_cog(icon_sync)
+
+    results = []
+    try:
+        for phase in ("cold", "steady"):
+            results.append(
+                await measure(
+                    f"mr-sync {phase}", guild.recorder, mr_sync.sync, args.trace_memory
+                )
+            )
+            results.append(
+                await measure(
+                    f"icon-sync {phase}",
+                    guild.recorder,
+                    icon_sync.sync_role_icons,
+                    args.trace_memory,
+                )
+            )
+    finally:
+        mr_sync.cog_unload()
+        icon_sync.cog_unload()
+        await client.close()
+
+    return results
+
+
+def run_benchmark(num_members, args):
+    games = get_bench_games()
+    guild, mr_role, game_roles, mr_users = make_guild(
+        num_members,
+        games,
+        get_ranking_role_names(),
+        mr_fraction=args.mr_fraction,
+        synced_fraction=args.synced_fraction,
+        seed=args.seed,
+    )
+    ranking_games = {name: game for name, game in MR_GAMES.items() if game}
+    server = StubMossrankingServer(
+        make_users_payload(mr_users, games),
+        make_ranking_payloads(mr_users, ranking_games, seed=args.seed),
+        etags=args.etags,
+    )
+    server.start()
+    try:
+        results = asyncio.run(
+            run_syncs(guild, mr_role, game_roles, server.base_url, args)
+        )
+    finally:
+        server.stop()
+
+    for result in results:
+        result["members"] = num_members
+        result["mr_users"] = len(mr_users)
+    return results
+
+
+def print_results(results):
+    columns = [
+        "members",
+        "scenario",
+        "wall_s",
+        "cpu_s",
+        "peak_mem_kib",
+        "edits",
+        "roles_added",
+        "roles_removed",
+    ]
+    widths = {
+        column: max(len(column), *(len(str(row[column])) for row in results))
+        for column in columns
+    }
+    print("  ".join(column.rjust(widths[column]) for column in columns))
+    for row in results:
+        print("  ".join(str(row[column]).rjust(widths[column]) for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--members",
+        type=int,
+        nargs="+",
+        default=[10000, 50000, 200000],
+        help="Guild sizes to benchmark.",
+    )
+    parser.add_argument(
+        "--mr-fraction",
+        type=float,
+        default=0.1,
+        help="Fraction of members linked on Mossranking.",
+    )
+    parser.add_argument(
+        "--synced-fraction",
+        type=float,
+        default=0.0,
+        help="Fraction of linked members already holding their roles.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--separate",
+        dest="unified",
+        action="store_false",
+        help="Leave badges to the badge sync instead of the Mossranking sync.",
+    )
+    parser.add_argument(
+        "--no-etags",
+        dest="etags",
+        action="store_false",
+        help="Serve payloads without ETags so only body digests detect them.",
+    )
+    parser.add_argument(
+        "--no-trace-memory",
+        dest="trace_memory",
+        action="store_false",
+        help="Skip tracemalloc, which otherwise inflates the timings.",
+    )
+    parser.add_argument("--json", help="Also write results to this file.")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    if args.trace_memory:
+        tracemalloc.start()
+
+    results = []
+    for num_members in args.members:
+        results.extend(run_benchmark(num_members, args))
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
+import time
+
+STARTED_AT = time.perf_counter()
+
 import argparse
 import json
 import logging
 import os
+import signal
 from pathlib import Path
 
 
@@ -13,38 +18,185 @@ from dotenv import load_dotenv
 load_dotenv("ghist-bot.env")
 
 from ghist.checks import (
-    SUPPORT_CHANNELS,
-    DOGS_CHANNELS,
-    DAILY_CHANNELS,
+    ChannelPolicy,
+    command_channel_check,
     globally_block_dms,
+    set_policy,
+)
+from ghist.member_cache import MemberFetcher
+from ghist.metrics import COMMAND_DURATION, MetricsServer
+from ghist.mossranking import MossrankingClient
+from ghist.planner import PlanRecorder
+from ghist.profiling import (
+    LoopWatchdog,
+    cog_context,
+    enable_cog_accounting,
+    track_listener,
 )
-from ghist.cogs.color import Color
-from ghist.cogs.spelunkicon import Spelunkicon
-from ghist.cogs.sync_ranking_icons import MossRankingIconSync
-from ghist.cogs.mr_sync import MossrankingSync
-from ghist.cogs.pronouns import Pronouns
-from ghist.cogs.ushabti import Ushabti
-from ghist.cogs.daily_channel_titles import DailyChannelTitles
+from ghist.role_applier import RoleApplier
+from ghist.role_index import RoleMemberIndex
+from ghist.role_registry import RoleRegistry
+from ghist.scheduler import Scheduler
+from ghist.snapshot import Snapshot
+from ghist.startup import StartupTimer
 
 
 TOKEN = os.environ["GHIST_BOT_TOKEN"]
 
+# Extensions loaded when the config doesn't list any.
+DEFAULT_EXTENSIONS = [
+    "ghist.cogs.admin",
+    "ghist.cogs.color",
+    "ghist.cogs.pronouns",
+    "ghist.cogs.ushabti",
+    "ghist.cogs.spelunkicon",
+    "ghist.cogs.daily_channel_titles",
+]
+MR_SYNC_EXTENSIONS = [
+    "ghist.cogs.mr_sync",
+    "ghist.cogs.sync_ranking_icons",
+]
+
 
 def parse_config(config_path):
     with config_path.open("r") as config_file:
         data = json.load(config_file)
 
-    for guild, channels in data.get("support-channels", {}).items():
-        SUPPORT_CHANNELS[guild] = channels
-
-    DOGS_CHANNELS.update(set(data.get("dogs-channels", [])))
-    DAILY_CHANNELS.update(set(data.get("daily-channels", [])))
+    set_policy(ChannelPolicy.from_config(data))
 
     return data
 
 
+def get_extensions(config):
+    extensions = config.get("extensions")
+    if extensions is None:
+        extensions = list(DEFAULT_EXTENSIONS)
+        if config.get("dogs-channels"):
+            extensions.append("ghist.cogs.dogs")
+        if config.get("mr-sync"):
+            extensions.extend(MR_SYNC_EXTENSIONS)
+    return extensions
+
+
 class GhistBotkeeper(commands.Bot):
-    pass
+    def __init__(self, *args, config=None, config_path=None, startup=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config = config or {}
+        self.config_path = config_path
+        self.startup = startup or StartupTimer()
+        self.mossranking = None
+        self.snapshot = None
+        self.member_fetcher = None
+        self.plan_recorder = None
+        self.role_applier = RoleApplier()
+        self.role_index = RoleMemberIndex()
+        self.role_registry = RoleRegistry()
+        self.scheduler = Scheduler(self.wait_until_ready)
+        self.metrics_server = None
+        self.watchdog = None
+        self.cog_accounting = False
+
+    def reload_policy(self):
+        """Reload channel rules from the config file without restarting.
+
+        Other settings still need a restart to take effect.
+        """
+        if self.config_path is None or not self.config_path.exists():
+            return False
+
+        try:
+            parse_config(self.config_path)
+        except (OSError, ValueError):
+            logging.exception("Failed to reload config from %s", self.config_path)
+            return False
+        return True
+
+    async def start(self, *args, **kwargs):
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        if self.watchdog is not None:
+            self.watchdog.start()
+        try:
+            self.loop.add_signal_handler(signal.SIGHUP, self.reload_policy)
+        except (AttributeError, NotImplementedError):
+            # No SIGHUP on this platform, reload with the command instead.
+            pass
+        await super().start(*args, **kwargs)
+
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            await super().invoke(ctx)
+            return
+
+        cog = ctx.cog.qualified_name if ctx.cog else "none"
+        with cog_context(cog), COMMAND_DURATION.time(
+            cog=cog, command=ctx.command.qualified_name
+        ):
+            await super().invoke(ctx)
+
+    def _schedule_event(self, coro, event_name, *args, **kwargs):
+        # Cog listeners are scheduled through here, so this is where their
+        # time can be accounted to the cog.
+        cog = getattr(coro, "__self__", None)
+        if self.cog_accounting and isinstance(cog, commands.Cog):
+            coro = track_listener(coro, cog.qualified_name, event_name)
+        return super()._schedule_event(coro, event_name, *args, **kwargs)
+
+    async def on_connect(self):
+        self.startup.mark("connect")
+        await super().on_connect()
+
+    async def on_ready(self):
+        if self.startup.mark("ready"):
+            self.startup.report()
+
+        # Member caches are rebuilt on a fresh session so drop the index and
+        # let it be rebuilt from the new cache the next time it's needed.
+        self.role_index.clear()
+        if self.member_fetcher is not None:
+            self.member_fetcher.clear()
+
+        self.role_registry.clear()
+        for guild in self.guilds:
+            self.role_registry.build(guild)
+
+    async def on_guild_remove(self, guild):
+        self.role_registry.remove_guild(guild)
+        if self.member_fetcher is not None:
+            self.member_fetcher.remove_guild(guild)
+
+    async def on_member_join(self, member):
+        self.role_index.add_member(member)
+        if self.member_fetcher is not None:
+            self.member_fetcher.add_member(member)
+
+    async def on_member_remove(self, member):
+        self.role_index.remove_member(member)
+
+    async def on_member_update(self, before, after):
+        self.role_index.update_member(before, after)
+
+    async def on_guild_role_create(self, role):
+        self.role_registry.add_role(role)
+
+    async def on_guild_role_update(self, before, after):
+        self.role_registry.update_role(before, after)
+
+    async def on_guild_role_delete(self, role):
+        self.role_index.remove_role(role)
+        self.role_registry.remove_role(role)
+
+    async def close(self):
+        self.scheduler.close()
+        if self.watchdog is not None:
+            self.watchdog.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.mossranking is not None:
+            await self.mossranking.close()
+        if self.snapshot is not None:
+            await self.snapshot.close()
+        await super().close()
 
 
 class HelpCommand(commands.DefaultHelpCommand):
@@ -86,39 +238,66 @@ def main():
     if args.config.exists():
         config = parse_config(args.config)
 
+    startup = StartupTimer(STARTED_AT)
+    startup.mark("import")
+
     intents = discord.Intents.default()
     intents.members = True
     intents.message_content = True
 
+    # With a minimal member cache guilds aren't chunked and members are only
+    # cached once a sync looks them up, so memory scales with the number of
+    # synced users rather than the size of each guild.
+    cache_options = {}
+    if config.get("minimal-member-cache"):
+        cache_options["member_cache_flags"] = discord.MemberCacheFlags.none()
+        cache_options["chunk_guilds_at_startup"] = False
+
     ghist = GhistBotkeeper(
-        command_prefix=args.prefix, help_command=HelpCommand(), intents=intents
+        command_prefix=args.prefix,
+        help_command=HelpCommand(),
+        intents=intents,
+        config=config,
+        config_path=args.config,
+        startup=startup,
+        **cache_options,
     )
+    if config.get("minimal-member-cache"):
+        ghist.member_fetcher = MemberFetcher(ghist.role_index)
 
-    # Cog Setup
-    ghist.add_cog(Color(ghist))
-    ghist.add_cog(Pronouns(ghist))
-    ghist.add_cog(Ushabti(ghist))
-    ghist.add_cog(Spelunkicon(ghist))
-    ghist.add_cog(DailyChannelTitles(ghist))
-
-    if config.get("mr-sync"):
-        ghist.add_cog(
-            MossrankingSync(
-                bot=ghist,
-                guild_id=config["mr-sync"]["guild-id"],
-                role_id=config["mr-sync"]["role-id"],
-                game_role_ids=config["mr-sync"].get("games", {}),
-            )
-        )
-        ghist.add_cog(
-            MossRankingIconSync(
-                bot=ghist,
-                guild_id=config["mr-sync"]["guild-id"],
-            )
+    if config.get("metrics"):
+        ghist.metrics_server = MetricsServer(
+            host=config["metrics"].get("host", "127.0.0.1"),
+            port=config["metrics"].get("port", 9102),
         )
 
+    profiling_config = config.get("profiling", {})
+    if profiling_config.get("slow-callback-threshold"):
+        ghist.watchdog = LoopWatchdog(profiling_config["slow-callback-threshold"])
+    if profiling_config.get("cog-accounting"):
+        # Before extensions are loaded so the tasks their jobs start are timed.
+        enable_cog_accounting(ghist.loop)
+        ghist.cog_accounting = True
+
+    mr_sync_config = config.get("mr-sync")
+    if mr_sync_config:
+        ghist.mossranking = MossrankingClient(key=os.environ["MR_SYNC_KEY"])
+        if mr_sync_config.get("snapshot"):
+            ghist.snapshot = Snapshot(mr_sync_config["snapshot"])
+        if mr_sync_config.get("record-dir"):
+            ghist.plan_recorder = PlanRecorder(mr_sync_config["record-dir"])
+        if mr_sync_config.get("dry-run"):
+            logging.info("Mossranking syncs will only log their role changes")
+            ghist.role_applier.dry_run = True
+
+    # Cog Setup
+    for extension in get_extensions(config):
+        ghist.load_extension(extension)
+    startup.mark("extensions")
+
     # Global Checks
     ghist.add_check(globally_block_dms)
+    ghist.add_check(command_channel_check)
 
     ghist.run(TOKEN)
 
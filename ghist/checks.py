@@ -1,31 +1,90 @@
-from collections import defaultdict
+import logging
+from dataclasses import dataclass, field
+from typing import FrozenSet, Mapping
 
+NO_CHANNELS = frozenset()
 
-# Mapping of guild to list of channels where the bot will respond.
-# If guild not found or channel list is empty then the bot will
-# respond in all channels.
-SUPPORT_CHANNELS = defaultdict(list)
 
-DOGS_CHANNELS = set()
+def to_channel_ids(channels):
+    return frozenset(int(channel_id) for channel_id in channels)
 
-DAILY_CHANNELS = set()
+
+@dataclass(frozen=True)
+class ChannelPolicy:
+    """Compiled channel rules from the config file.
+
+    Policies are immutable and replaced as a whole on reload so a check
+    never sees a half-applied config.
+    """
+
+    # Mapping of guild to the channels where support commands are used.
+    # If guild not found or channel list is empty then the bot will
+    # respond in all channels.
+    support_channels: Mapping[int, FrozenSet[int]] = field(default_factory=dict)
+    dogs_channels: FrozenSet[int] = NO_CHANNELS
+    daily_channels: FrozenSet[int] = NO_CHANNELS
+    # Mapping of command name to the only channels it can be used in.
+    command_channels: Mapping[str, FrozenSet[int]] = field(default_factory=dict)
+
+    @classmethod
+    def from_config(cls, data):
+        return cls(
+            support_channels={
+                int(guild_id): to_channel_ids(channels)
+                for guild_id, channels in data.get("support-channels", {}).items()
+            },
+            dogs_channels=to_channel_ids(data.get("dogs-channels", [])),
+            daily_channels=to_channel_ids(data.get("daily-channels", [])),
+            command_channels={
+                command: to_channel_ids(channels)
+                for command, channels in data.get("command-channels", {}).items()
+            },
+        )
+
+    def get_support_channels(self, guild_id):
+        return self.support_channels.get(guild_id, NO_CHANNELS)
+
+
+_policy = ChannelPolicy()
+
+
+def get_policy():
+    return _policy
+
+
+def set_policy(policy):
+    global _policy  # pylint: disable=global-statement
+    _policy = policy
+    logging.info(
+        "Loaded channel policy for %s guilds and %s commands",
+        len(policy.support_channels),
+        len(policy.command_channels),
+    )
 
 
 async def globally_block_dms(ctx):
     return ctx.guild is not None
 
 
+async def command_channel_check(ctx):
+    if ctx.command is None:
+        return True
+
+    channels = _policy.command_channels.get(ctx.command.qualified_name)
+    return channels is None or ctx.channel.id in channels
+
+
 async def is_support_channel(ctx):
     if ctx.guild is None:
         return False
 
-    channels = SUPPORT_CHANNELS.get(str(ctx.guild.id))
-    return str(ctx.message.channel.id) in channels
+    channels = _policy.get_support_channels(ctx.guild.id)
+    return not channels or ctx.channel.id in channels
 
 
 async def not_support_channel(ctx):
     if ctx.guild is None:
         return False
 
-    channels = SUPPORT_CHANNELS.get(str(ctx.guild.id))
-    return str(ctx.message.channel.id) not in channels
+    channels = _policy.get_support_channels(ctx.guild.id)
+    return not channels or ctx.channel.id not in channels
@@ -0,0 +1,96 @@
+import asyncio
+import io
+import threading
+
+import discord
+from discord.ext import commands
+
+from ghist.metrics import COG_BUSY_SECONDS
+from ghist.profiling import MAX_PROFILE_SECONDS, SamplingProfiler
+
+
+def format_busy_seconds(before, after):
+    busy = {
+        key: value - before.get(key, 0.0)
+        for key, value in after.items()
+        if value - before.get(key, 0.0) > 0
+    }
+    return "\n".join(
+        f"{cog}: {seconds:.3f}s"
+        for (cog,), seconds in sorted(busy.items(), key=lambda item: -item[1])
+    )
+
+
+class Admin(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.profiler = None
+
+    @commands.command(
+        help="Reload channel rules from the config file.",
+        brief="Reload channel rules.",
+        hidden=True,
+    )
+    @commands.is_owner()
+    async def reload(self, ctx):
+        if self.bot.reload_policy():
+            await ctx.message.add_reaction("👍")
+        else:
+            await ctx.send("Failed to reload the config, see the logs for details.")
+
+    @commands.command(
+        help="Run a scheduled job now instead of waiting for its next run.",
+        brief="Run a scheduled job now.",
+        hidden=True,
+    )
+    @commands.is_owner()
+    async def runjob(self, ctx, name=None):
+        jobs = self.bot.scheduler.jobs
+        if name not in jobs:
+            await ctx.send(
+                "Scheduled jobs: {}".format(", ".join(f"`{job}`" for job in jobs))
+            )
+            return
+
+        self.bot.scheduler.run_now(name)
+        await ctx.message.add_reaction("👍")
+
+    @commands.command(
+        help=(
+            "Sample what the event loop is running for a number of seconds and "
+            "upload the collapsed stacks, ready for a flame graph."
+        ),
+        brief="Profile the event loop.",
+        hidden=True,
+    )
+    @commands.is_owner()
+    async def profile(self, ctx, seconds: int = 10):
+        if self.profiler is not None:
+            await ctx.send("A profile is already running.")
+            return
+
+        seconds = max(1, min(seconds, MAX_PROFILE_SECONDS))
+        # Commands run on the loop thread, which is the one worth sampling.
+        self.profiler = profiler = SamplingProfiler(threading.get_ident())
+        busy_before = COG_BUSY_SECONDS.get_values()
+        profiler.start()
+        await ctx.message.add_reaction("⏱️")
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.profiler = None
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, profiler.stop)
+
+        message = f"Collected {profiler.total} samples over {seconds}s."
+        busy = format_busy_seconds(busy_before, COG_BUSY_SECONDS.get_values())
+        if busy:
+            message += f"\nLoop time by cog:\n```\n{busy}\n```"
+        await ctx.send(
+            message,
+            file=discord.File(io.BytesIO(profiler.render().encode()), "profile.txt"),
+        )
+
+
+def setup(bot):
+    bot.add_cog(Admin(bot))
@@ -1,20 +1,31 @@
+import asyncio
 import colorsys
 import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from math import ceil
 
 import discord
 from discord.ext import commands
-from ttf_opensans import opensans
-from PIL import Image, ImageDraw
 
 
-from ghist.checks import SUPPORT_CHANNELS, is_support_channel
+from ghist.checks import is_support_channel
+from ghist.metrics import PALETTE_IMAGE_BYTES
 
 COLOR_PREFIX = "Color: "
 
-IMG_FONT = opensans(font_weight=600).imagefont(size=16)
 FONT_X_PADDING = 5
 FONT_Y_PADDING = 5
+MAX_CONCURRENT_RENDERS = 2
+PNG_FORMAT = "png"
+WEBP_FORMAT = "webp"
+PALETTE_SIZE = 256
+# Shades between each swatch and its text color kept for antialiased text,
+# as many as fit in the palette up to this.
+MAX_TEXT_SHADES = 6
+# Maps each channel of an image difference to 255 where it's zero.
+EXACT_MATCH_LUT = [255] + [0] * 255
 
 
 def chunk(items, num_chunks=3):
@@ -30,21 +41,33 @@ def chunk(items, num_chunks=3):
     return chunks
 
 
+@lru_cache(maxsize=None)
+def get_font():
+    # The font and PIL are only loaded once a palette is first rendered.
+    from ttf_opensans import opensans  # pylint: disable=import-outside-toplevel
+
+    return opensans(font_weight=600).imagefont(size=16)
+
+
 def get_text_color(rgb):
     if (rgb[0] * 0.299 + rgb[1] * 0.587 + rgb[2] * 0.114) > 160:
         return (0, 0, 0, 255)
     return (255, 255, 255, 255)
 
 
-def make_available_colors_image(roles):
+def get_layout(colors):
+    """Lay out a mapping of color name to RGB tuple as a palette image.
 
+    Returns the image size and the box, name and RGB of every swatch.
+    """
+    font = get_font()
     max_column_widths = []
     max_text_height = 0
 
     roles = [
         (k, v)
         for k, v in sorted(
-            roles.items(), key=lambda role: colorsys.rgb_to_hsv(*role[1].color.to_rgb())
+            colors.items(), key=lambda color: colorsys.rgb_to_hsv(*color[1])
         )
     ]
     roles = chunk(roles, 3)
@@ -54,7 +77,7 @@ def make_available_colors_image(roles):
             if len(max_column_widths) == column_idx:
                 max_column_widths.append(0)
 
-            width, height = IMG_FONT.getsize(role_name, None, None, None, 0)
+            width, height = font.getsize(role_name, None, None, None, 0)
             max_text_height = max(max_text_height, height)
             max_column_widths[column_idx] = max(max_column_widths[column_idx], width)
 
@@ -64,51 +87,255 @@ def make_available_colors_image(roles):
         (max_len_column * 2) * FONT_Y_PADDING
     )
 
-    out_img = Image.new("RGBA", (img_width, img_height))
-    img_draw = ImageDraw.Draw(out_img)
-
+    swatches = []
     x0 = 0
     for column_idx, column in enumerate(roles):
         column_width = max_column_widths[column_idx] + FONT_X_PADDING * 2
-        for row_idx, (role_name, role) in enumerate(column):
+        for row_idx, (role_name, rgb) in enumerate(column):
             row_height = max_text_height + FONT_Y_PADDING * 2
             x1 = x0 + column_width - 1
             y0 = row_idx * row_height
             y1 = y0 + row_height - 1
-            img_draw.rectangle([x0, y0, x1, y1], fill=role.color.to_rgb())
-            img_draw.text(
-                (x0 + FONT_X_PADDING, y0 + FONT_Y_PADDING),
-                role_name,
-                font=IMG_FONT,
-                fill=get_text_color(role.color.to_rgb()),
-            )
+            swatches.append(((x0, y0, x1, y1), role_name, rgb))
 
         x0 += column_width
 
+    return (img_width, img_height), swatches
+
+
+def draw_available_colors(size, swatches):
+    """Draw swatches laid out by `get_layout` into a palette image."""
+    from PIL import Image, ImageDraw  # pylint: disable=import-outside-toplevel
+
+    font = get_font()
+    out_img = Image.new("RGBA", size)
+    img_draw = ImageDraw.Draw(out_img)
+
+    for (x0, y0, x1, y1), role_name, rgb in swatches:
+        img_draw.rectangle([x0, y0, x1, y1], fill=rgb)
+        img_draw.text(
+            (x0 + FONT_X_PADDING, y0 + FONT_Y_PADDING),
+            role_name,
+            font=font,
+            fill=get_text_color(rgb),
+        )
+
+    return out_img
+
+
+def get_palette(swatches):
+    """Build a 256 color palette that holds every swatch color exactly.
+
+    Each swatch also gets shades towards its text color for the antialiased
+    edges of its name while there's room, which leaves text edges snapping
+    to the swatch or text color with over 126 swatches. Returns None if the
+    swatches alone don't fit.
+    """
+    swatch_colors = sorted({rgb for _, _, rgb in swatches})
+    # Black and white text plus an entry for transparent pixels.
+    free = PALETTE_SIZE - 3 - len(swatch_colors)
+    if free < 0:
+        return None
+    shades = min(MAX_TEXT_SHADES, free // max(len(swatch_colors), 1))
+
+    palette = [(0, 0, 0), (255, 255, 255)]
+    for rgb in swatch_colors:
+        text_rgb = get_text_color(rgb)[:3]
+        palette.append(rgb)
+        for step in range(1, shades + 1):
+            fraction = step / (shades + 1)
+            palette.append(
+                tuple(
+                    round(channel + (text_channel - channel) * fraction)
+                    for channel, text_channel in zip(rgb, text_rgb)
+                )
+            )
+    return palette
+
+
+def get_color_mask(img, rgb):
+    """Mask of the pixels of an RGB image that are exactly `rgb`."""
+    from PIL import Image, ImageChops  # pylint: disable=import-outside-toplevel
+
+    diff = ImageChops.difference(img, Image.new("RGB", img.size, rgb))
+    red, green, blue = diff.point(EXACT_MATCH_LUT * 3).split()
+    return ImageChops.darker(red, ImageChops.darker(green, blue))
+
+
+def quantize_to_palette(img, palette, swatches):
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    # The last entry is kept for transparent pixels. It's black as well, so
+    # black pixels still map to the first entry.
+    transparent_idx = len(palette)
+    palette_img = Image.new("P", (1, 1))
+    palette_img.putpalette([channel for rgb in palette for channel in rgb] + [0, 0, 0])
+    rgb_img = img.convert("RGB")
+    out_img = rgb_img.quantize(palette=palette_img, dither=Image.NONE)
+
+    # Pillow looks colors up in a coarse cache rather than searching for the
+    # nearest entry, which can map a swatch to a close by entry. Swatches
+    # are set to their own entry so only text edges are approximated.
+    palette_idx = {}
+    for idx, rgb in enumerate(palette):
+        palette_idx.setdefault(rgb, idx)
+    for (x0, y0, x1, y1), _, rgb in swatches:
+        box = (x0, y0, x1 + 1, y1 + 1)
+        out_img.paste(
+            palette_idx[rgb], box, mask=get_color_mask(rgb_img.crop(box), rgb)
+        )
+
+    transparent = img.getchannel("A").point(lambda alpha: 255 if alpha == 0 else 0)
+    if transparent.getbbox() is None:
+        return out_img, {}
+
+    out_img.paste(transparent_idx, mask=transparent)
+    return out_img, {"transparency": transparent_idx}
+
+
+def encode_image(img, swatches, image_format=PNG_FORMAT):
+    """Encode a palette image, returning the buffer and the format used.
+
+    PNGs use a 256 color palette holding every swatch color exactly when
+    the colors fit, see `get_palette`, and are quantized otherwise. WebP is
+    encoded losslessly and falls back to PNG if Pillow was built without
+    it.
+    """
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
     buf = io.BytesIO()
-    out_img.save(buf, format="PNG")
+    if image_format == WEBP_FORMAT:
+        try:
+            img.save(buf, format="WEBP", lossless=True)
+        except (KeyError, OSError):
+            logging.warning("WebP isn't supported, falling back to PNG")
+            image_format = PNG_FORMAT
+            buf = io.BytesIO()
+
+    if image_format != WEBP_FORMAT:
+        image_format = PNG_FORMAT
+        palette = get_palette(swatches)
+        if palette is None:
+            out_img = img.quantize(colors=PALETTE_SIZE, method=Image.FASTOCTREE)
+            options = {}
+        else:
+            out_img, options = quantize_to_palette(img, palette, swatches)
+        out_img.save(buf, format="PNG", optimize=True, **options)
+
     buf.seek(0)
+    return buf, image_format
 
-    return buf
 
+def make_available_colors_image(colors, image_format=PNG_FORMAT):
+    """Render a mapping of color name to RGB tuple into an encoded palette.
+
+    Only plain data is passed in so that this can safely run off the
+    event loop in a worker thread.
+    """
+    size, swatches = get_layout(colors)
+    return encode_image(draw_available_colors(size, swatches), swatches, image_format)
 
-class Color(commands.Cog):
-    def __init__(self, bot):
-        self.bot = bot
+
+class PaletteCache:
+    """Per-guild cache of rendered color palette images.
+
+    Images are stored encoded alongside a fingerprint of the color roles
+    they were rendered from and are re-rendered whenever the fingerprint
+    no longer matches. Rendering happens on a small thread pool and
+    concurrent requests for the same palette share one render.
+    """
+
+    def __init__(self, max_renders=MAX_CONCURRENT_RENDERS, image_format=PNG_FORMAT):
+        self.image_format = image_format
+        self._images = {}
+        self._renders = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_renders, thread_name_prefix="palette-render"
+        )
 
     @staticmethod
-    def get_colors_roles(roles):
-        colors = {}
-        for role in roles:
-            if role.name.startswith(COLOR_PREFIX):
-                colors[role.name[len(COLOR_PREFIX) :].lower()] = role
-        return colors
+    def get_fingerprint(roles):
+        return tuple(
+            sorted((role.id, name, role.color.value) for name, role in roles.items())
+        )
+
+    def _render(self, fingerprint, roles):
+        render = self._renders.get(fingerprint)
+        if render is not None:
+            return render
+
+        colors = {name: role.color.to_rgb() for name, role in roles.items()}
+        loop = asyncio.get_event_loop()
+        render = loop.run_in_executor(
+            self._executor, make_available_colors_image, colors, self.image_format
+        )
+        self._renders[fingerprint] = render
+        render.add_done_callback(lambda _: self._renders.pop(fingerprint, None))
+        return render
+
+    async def get(self, guild_id, roles):
+        """Return the guild's palette as a buffer and a filename for it."""
+        fingerprint = self.get_fingerprint(roles)
+        cached = self._images.get(guild_id)
+        if cached is None or cached[0] != fingerprint:
+            image, image_format = await asyncio.shield(self._render(fingerprint, roles))
+            cached = (fingerprint, image.getvalue(), image_format)
+            self._images[guild_id] = cached
+            PALETTE_IMAGE_BYTES.observe(len(cached[1]), format=image_format)
+        return io.BytesIO(cached[1]), f"colors.{cached[2]}"
+
+    def invalidate(self, guild_id):
+        self._images.pop(guild_id, None)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class Color(commands.Cog):
+    def __init__(self, bot, image_format=PNG_FORMAT):
+        self.bot = bot
+        self.palettes = PaletteCache(image_format=image_format)
+        self.bot.role_registry.register(COLOR_PREFIX)
+
+    def cog_unload(self):
+        self.palettes.close()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        for guild in self.bot.guilds:
+            guild_color_roles = self.get_colors_roles(guild)
+            if guild_color_roles:
+                await self.palettes.get(guild.id, guild_color_roles)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        if role.name.startswith(COLOR_PREFIX):
+            self.palettes.invalidate(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        if before.name.startswith(COLOR_PREFIX) or after.name.startswith(
+            COLOR_PREFIX
+        ):
+            self.palettes.invalidate(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        if role.name.startswith(COLOR_PREFIX):
+            self.palettes.invalidate(role.guild.id)
+
+    def get_colors_roles(self, guild):
+        return self.bot.role_registry.get(guild, COLOR_PREFIX)
 
     def get_guild_colors(self, ctx):
-        return self.get_colors_roles(ctx.guild.roles)
+        return self.get_colors_roles(ctx.guild)
 
     def get_author_colors(self, ctx):
-        return self.get_colors_roles(ctx.author.roles)
+        return {
+            name: role
+            for name, role in self.get_colors_roles(ctx.guild).items()
+            if ctx.author.get_role(role.id) is not None
+        }
 
     @commands.command(
         aliases=["colour"],
@@ -126,15 +353,17 @@ class Color(commands.Cog):
 
         # Check that the user passed a color at all
         if not args:
-            img_file = make_available_colors_image(guild_color_roles)
-            await ctx.send(
-                "Available colors:", file=discord.File(img_file, "colors.png")
+            img_file, filename = await self.palettes.get(
+                ctx.guild.id, guild_color_roles
             )
+            await ctx.send("Available colors:", file=discord.File(img_file, filename))
             return
 
         requested_color = " ".join(args).strip().lower()
         if requested_color.lower() == "none":
-            await ctx.author.remove_roles(*self.get_author_colors(ctx).values())
+            await self.bot.role_applier.remove_roles(
+                ctx.author, "color", *self.get_author_colors(ctx).values()
+            )
             await ctx.message.add_reaction("👍")
             return
 
@@ -149,12 +378,15 @@ class Color(commands.Cog):
         # Give requested color role. We add the color first as small
         # UI benefit so we don't see the color flash back to default color
         # when changing colors.
-        await ctx.author.add_roles(target_role)
+        await self.bot.role_applier.add_roles(ctx.author, "color", target_role)
 
         # Remove other color roles
         roles_to_remove = set(self.get_author_colors(ctx).values())
         roles_to_remove.discard(target_role)
-        if roles_to_remove:
-            await ctx.author.remove_roles(*roles_to_remove)
+        await self.bot.role_applier.remove_roles(ctx.author, "color", *roles_to_remove)
 
         await ctx.message.add_reaction("👍")
+
+
+def setup(bot):
+    bot.add_cog(Color(bot, image_format=bot.config.get("palette-format", PNG_FORMAT)))
@@ -3,10 +3,11 @@ import re
 import time
 from datetime import datetime
 
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 
-from ghist.checks import DAILY_CHANNELS
+from ghist.checks import get_policy
+from ghist.scheduler import DailyTrigger
 
 TOPIC_RE = re.compile(r"^(.*)( \d\d\d\d-\d\d-\d\d started <t:\d+:R>.)(.*)$")
 
@@ -30,7 +31,10 @@ class DailyChannelTitles(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.last_known_date = None
-        self.syncer.start()  # pylint: disable=no-member
+        self.bot.scheduler.add_job("daily-titles", self.syncer, DailyTrigger())
+
+    def cog_unload(self):
+        self.bot.scheduler.remove_job("daily-titles")
 
     def get_today_str(self, dt_obj):
         return "{:04}-{:02}-{:02}".format(dt_obj.year, dt_obj.month, dt_obj.day)
@@ -41,17 +45,17 @@ class DailyChannelTitles(commands.Cog):
 
         return today_str != self.last_known_date
 
-    @tasks.loop(seconds=60.0)
     async def syncer(self):
+        """Update the daily channel topics, returning None if that failed."""
         today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
         date_str = self.get_today_str(today)
         if not self.should_sync(date_str):
-            return
+            return False
 
         logging.info("Syncing for Date: %s", date_str)
         try:
-            for channel_id in DAILY_CHANNELS:
-                channel = self.bot.get_channel(int(channel_id))
+            for channel_id in get_policy().daily_channels:
+                channel = self.bot.get_channel(channel_id)
                 topic = get_updated_topic(channel.topic or "", today, date_str)
                 await channel.edit(topic=topic)
                 logging.info(
@@ -61,8 +65,10 @@ class DailyChannelTitles(commands.Cog):
             self.last_known_date = date_str
         except Exception:
             logging.exception("Failed to sync daily channels.")
+            return
+
+        return True
+
 
-    @syncer.before_loop
-    async def before_syncer(self):
-        logging.info("Waiting for bot to be reading before starting sync task...")
-        await self.bot.wait_until_ready()
+def setup(bot):
+    bot.add_cog(DailyChannelTitles(bot))
@@ -1,15 +1,104 @@
+import asyncio
 import logging
+from collections import deque
+
+import discord
 from discord.ext import commands
 
-from ghist.checks import DOGS_CHANNELS
+from ghist.checks import get_policy
+from ghist.metrics import REACTION_QUEUE_DEPTH, REACTIONS
+from ghist.role_applier import RateLimiter
+
+DOGS_REACTION = "🦊"
+# Pending reactions kept per channel. Once full the oldest are dropped as
+# reacting to a message long after it was sent isn't worth the request.
+REACTION_QUEUE_SIZE = 20
+REACTION_RATE = 3
+REACTION_PER = 1.0
+
+
+class ReactionQueue:
+    """Bounded per-channel queues of messages to react to.
+
+    Each channel is drained by its own task, paced by a token bucket, so a
+    burst in one channel neither blocks others nor piles up requests
+    against Discord's reaction rate limit.
+    """
+
+    def __init__(
+        self,
+        emoji,
+        max_size=REACTION_QUEUE_SIZE,
+        rate=REACTION_RATE,
+        per=REACTION_PER,
+    ):
+        self.emoji = emoji
+        self.max_size = max_size
+        self.rate = rate
+        self.per = per
+        self._queues = {}
+        self._limiters = {}
+        self._tasks = {}
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def put(self, message):
+        channel_id = message.channel.id
+        queue = self._queues.get(channel_id)
+        if queue is None:
+            queue = self._queues[channel_id] = deque(maxlen=self.max_size)
+            self._limiters[channel_id] = RateLimiter(self.rate, self.per)
+
+        if len(queue) == self.max_size:
+            REACTIONS.inc(result="dropped")
+        queue.append(message)
+        REACTION_QUEUE_DEPTH.set(len(self))
+
+        task = self._tasks.get(channel_id)
+        if task is None or task.done():
+            self._tasks[channel_id] = asyncio.ensure_future(self._drain(channel_id))
+
+    async def _drain(self, channel_id):
+        queue = self._queues[channel_id]
+        limiter = self._limiters[channel_id]
+        while queue:
+            await limiter.acquire()
+            if not queue:
+                break
+            message = queue.popleft()
+            REACTION_QUEUE_DEPTH.set(len(self))
+            try:
+                await message.add_reaction(self.emoji)
+            except discord.HTTPException:
+                logging.exception("Failed to react to message %s", message.id)
+                REACTIONS.inc(result="failed")
+                continue
+            REACTIONS.inc(result="sent")
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self._queues.clear()
+        self._limiters.clear()
+        REACTION_QUEUE_DEPTH.set(0)
 
 
 class Dogs(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.reactions = ReactionQueue(DOGS_REACTION)
+
+    def cog_unload(self):
+        self.reactions.cancel()
 
     @commands.Cog.listener()
     async def on_message(self, message):
-        if str(message.channel.id) not in DOGS_CHANNELS:
+        if message.channel.id not in get_policy().dogs_channels:
             return
-        await message.add_reaction("🦊")
+        self.reactions.put(message)
+
+
+def setup(bot):
+    bot.add_cog(Dogs(bot))
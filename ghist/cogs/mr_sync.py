@@ -1,16 +1,30 @@
+import asyncio
 import logging
-import os
-import re
+import time
 from dataclasses import dataclass
+from typing import Dict, List
 
-from typing import Dict
+from discord.ext import commands
 
-import aiohttp
-from discord.ext import commands, tasks
+from ghist.metrics import SYNC_PHASE_DURATION
+from ghist.mossranking import MossrankingError, NotModified, Validators
+from ghist.planner import (
+    get_member_roles,
+    member_roles_for_recording,
+    plan_members,
+    plan_mossranking_member,
+    queue_plans,
+)
+from ghist.role_applier import RoleChanges
+from ghist.scheduler import IntervalTrigger
+from ghist.snapshot import SyncState, get_fingerprint
 
-MR_SYNC_KEY = os.environ["MR_SYNC_KEY"]
-MR_SYNC_ENDPOINT = "https://mossranking.com/api/getdiscordusers.php"
-GAMES_RE = re.compile(r"^games\[([A-Za-z0-9 ]+)\]$")
+SYNC_NAME = "mr-sync"
+# Badges are planned into the same edits when the badge sync is loaded.
+ICON_SYNC_COG = "MossRankingIconSync"
+SYNC_INTERVAL = 1800.0
+# Runs that change nothing back off up to this interval.
+MAX_SYNC_INTERVAL = 4 * 60 * 60.0
 
 
 @dataclass
@@ -32,126 +46,339 @@ class MossRecord:
     ]
     """
 
+    __slots__ = ("mossranking_id", "discord_id", "games")
+
     mossranking_id: int
-    mossranking_username: str
     discord_id: int
-    discord_username: str
-    games: Dict[str, bool]
+    # Bitmask of the games this user has, see `get_game_bits`.
+    games: int
 
     @classmethod
-    def from_dict(cls, data):
-        games = {}
-
-        for key, value in data.items():
-            match = GAMES_RE.match(key)
-            if match:
-                games[match.group(1)] = value
+    def from_dict(cls, data, game_keys):
+        games = 0
+        for key, bit in game_keys.items():
+            if data.get(key):
+                games |= bit
 
         return cls(
             mossranking_id=int(data.get("mossranking[id_user]", 0)),
-            mossranking_username=data.get("mossranking[username]", ""),
             discord_id=int(data.get("discord[id]", 0)),
-            discord_username=data.get("discord[username]", ""),
             games=games,
         )
 
+    def has_game(self, bit):
+        return bool(self.games & bit)
+
+
+def get_game_bits(games):
+    return {game: 1 << idx for idx, game in enumerate(games)}
+
+
+@dataclass
+class MossrankingGuild:
+    """The roles a guild gives to linked Mossranking users."""
+
+    guild_id: int
+    role_id: int
+    game_role_ids: Dict[str, int]
+
+    @classmethod
+    def from_config(cls, data):
+        return cls(
+            guild_id=data["guild-id"],
+            role_id=data["role-id"],
+            game_role_ids=data.get("games", {}),
+        )
+
 
 class MossrankingSync(commands.Cog):
-    def __init__(self, bot, guild_id, role_id, game_role_ids):
+    def __init__(self, bot, guilds: List[MossrankingGuild]):
         self.bot = bot
-        self.guild_id = guild_id
-        self.role_id = role_id
-        self.game_role_ids = game_role_ids
+        self.guilds = guilds
+        # Users are parsed once per sync for every game any guild maps.
+        games = dict.fromkeys(game for guild in guilds for game in guild.game_role_ids)
+        self.game_bits = get_game_bits(games)
+        self.game_keys = {
+            f"games[{game}]": bit for game, bit in self.game_bits.items()
+        }
+        self.states = {
+            guild.guild_id: SyncState(f"mr-users-{guild.guild_id}") for guild in guilds
+        }
+        # The last users payload every guild was reconciled against. While
+        # Mossranking keeps returning it, only members who joined or whose
+        # roles changed since are synced.
+        self.validators = Validators()
+        self.records = {}
+        self.joined = {}
 
-        self.syncer.start()  # pylint: disable=no-member
+        self.job = self.bot.scheduler.add_job(
+            SYNC_NAME,
+            self.sync,
+            IntervalTrigger(
+                SYNC_INTERVAL, jitter=0.1, backoff=2.0, max_seconds=MAX_SYNC_INTERVAL
+            ),
+        )
 
-    async def get_mr_discord_users(self):
+    def cog_unload(self):
+        self.bot.scheduler.remove_job(SYNC_NAME)
+
+    async def get_mr_discord_users(self, validators=None):
         records = {}
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                MR_SYNC_ENDPOINT, params={"key": MR_SYNC_KEY}
-            ) as req:
-                if req.status != 200:
-                    return
-                data = await req.json()
-
-        for user in data:
-            record = MossRecord.from_dict(user)
-            if not record.discord_id:
-                continue
-            records[record.discord_id] = record
+        # Records are parsed as they stream in so time spent parsing is
+        # tracked separately from the time spent waiting on the api.
+        start = time.perf_counter()
+        parse_time = 0.0
+        try:
+            async for user in self.bot.mossranking.iter_discord_users(validators):
+                parse_start = time.perf_counter()
+                record = MossRecord.from_dict(user, self.game_keys)
+                if record.discord_id:
+                    records[record.discord_id] = record
+                parse_time += time.perf_counter() - parse_start
+        except MossrankingError:
+            logging.exception("Failed to fetch Mossranking users")
+            return
+        finally:
+            SYNC_PHASE_DURATION.observe(
+                time.perf_counter() - start - parse_time, sync=SYNC_NAME, phase="fetch"
+            )
+            SYNC_PHASE_DURATION.observe(parse_time, sync=SYNC_NAME, phase="parse")
 
         return records
 
-    def get_games_roles(self, guild):
+    def get_games_roles(self, guild, config: MossrankingGuild):
         roles = {}
-        for game, role_id in self.game_role_ids.items():
+        for game, role_id in config.game_role_ids.items():
             role = guild.get_role(role_id)
             if role is None:
                 continue
             roles[game] = role
         return roles
 
-    @tasks.loop(seconds=1800.0)
-    async def syncer(self):
-        guild = self.bot.get_guild(self.guild_id)
-        if not guild:
+    def encode_snapshot(self, records):
+        return {
+            "games": list(self.game_bits),
+            "records": [
+                [record.discord_id, record.mossranking_id, record.games]
+                for record in records.values()
+            ],
+        }
+
+    def decode_snapshot(self, body):
+        # Game bitmasks are only meaningful for the same configured games.
+        if body.get("games") != list(self.game_bits):
+            return None
+
+        records = {}
+        for discord_id, mossranking_id, games in body["records"]:
+            records[discord_id] = MossRecord(
+                mossranking_id=mossranking_id, discord_id=discord_id, games=games
+            )
+        return records
+
+    async def sync(self):
+        guilds = []
+        for config in self.guilds:
+            guild = self.bot.get_guild(config.guild_id)
+            if guild is not None:
+                guilds.append((config, guild))
+        if not guilds:
+            return
+
+        snapshot = self.bot.snapshot
+        if snapshot is not None:
+            for config, _ in guilds:
+                state = self.states[config.guild_id]
+                if not state.loaded:
+                    await snapshot.load(state, config.guild_id, self.decode_snapshot)
+
+        # Users are fetched once and every guild is reconciled against the
+        # same payload.
+        fetched_at = time.time()
+        validators = self.validators.copy()
+        try:
+            mr_records_by_did = await self.get_mr_discord_users(validators)
+            unchanged = (
+                mr_records_by_did is not None
+                and validators.digest == self.validators.digest
+            )
+        except NotModified:
+            unchanged = True
+
+        if unchanged:
+            logging.info("Mossranking users unchanged, syncing changed members only")
+            mr_records_by_did = self.records
+
+        changes_by_guild = {guild.id: RoleChanges() for _, guild in guilds}
+        finishers = await asyncio.gather(
+            *(
+                self.reconcile_guild(
+                    config,
+                    guild,
+                    changes_by_guild[guild.id],
+                    mr_records_by_did,
+                    fetched_at,
+                    incremental=unchanged,
+                )
+                for config, guild in guilds
+            )
+        )
+
+        # Badges depend on the game roles planned above, so they are planned
+        # on top of them and every member gets at most one edit for both.
+        # Holding the badge sync's lock keeps its own runs from planning
+        # against roles that are about to change.
+        icon_sync = self.bot.get_cog(ICON_SYNC_COG)
+        if icon_sync is None:
+            await self.apply(changes_by_guild)
+        else:
+            async with icon_sync.job.lock:
+                finish_icons = await icon_sync.reconcile(changes_by_guild)
+                await self.apply(changes_by_guild)
+                if finish_icons is not None:
+                    await finish_icons()
+
+        for finish in finishers:
+            if finish is not None:
+                await finish()
+
+        # Only back off when every guild actually ran and changed nothing.
+        if None in finishers:
             return
 
-        role = guild.get_role(self.role_id)
+        if mr_records_by_did and not unchanged:
+            self.validators = validators
+            self.records = mr_records_by_did
+        return any(changes_by_guild.values())
+
+    async def apply(self, changes_by_guild):
+        await self.bot.role_applier.apply_all(
+            changes_by_guild, source=SYNC_NAME, reason="Mossranking sync"
+        )
+
+    async def reconcile_guild(
+        self, config, guild, changes, mr_records_by_did, fetched_at, incremental=False
+    ):
+        """Queue one guild's role changes onto `changes`.
+
+        Returns a coroutine function that stores the guild's state once the
+        changes have been applied, or None if the guild couldn't be synced.
+        Incremental syncs only look at members who joined or whose managed
+        roles changed since the last sync, as `mr_records_by_did` is the
+        payload that was already reconciled.
+        """
+        state = self.states[config.guild_id]
+        joined = self.joined.pop(config.guild_id, set())
+
+        role = guild.get_role(config.role_id)
         if not role:
             return
 
-        game_roles = self.get_games_roles(guild)
+        game_roles = self.get_games_roles(guild, config)
 
-        mr_records_by_did = await self.get_mr_discord_users()
         # Safety check in case api returns empty data
         if not mr_records_by_did:
-            return
+            if not state.payload or not state.is_fresh():
+                return
+            logging.warning(
+                "Falling back to snapshot of Mossranking users for %s", guild.name
+            )
+            mr_records_by_did = state.payload
+            fetched_at = state.fetched_at
+
+        reconcile_start = time.perf_counter()
+
+        game_role_bits = {
+            game_role.id: self.game_bits[game] for game, game_role in game_roles.items()
+        }
+
+        # Only members whose payload entry or managed roles changed since the
+        # last sync can need changes, so skip everyone else in the guild.
+        managed_roles = [role, *game_roles.values()]
+        self.bot.role_index.track(guild, managed_roles)
+        held_roles = self.bot.role_index.roles_by_member(managed_roles)
+        fingerprint = get_fingerprint(role.id, game_role_bits)
+        member_ids = state.get_members_to_plan(
+            mr_records_by_did, held_roles, fingerprint, incremental
+        )
+        if incremental:
+            member_ids.update(
+                member_id for member_id in joined if member_id in mr_records_by_did
+            )
+        if self.bot.member_fetcher is not None:
+            await self.bot.member_fetcher.fetch(guild, member_ids)
+
+        def plan_member(member_id, held):
+            record = mr_records_by_did.get(member_id)
+            return plan_mossranking_member(
+                member_id,
+                held,
+                record.games if record else None,
+                role.id,
+                game_role_bits,
+            )
+
+        member_roles = get_member_roles(guild, member_ids)
+        plans, absent_ids = plan_members(member_roles, member_ids, plan_member)
+
+        queue_plans(changes, guild, plans, {role.id: role for role in managed_roles})
+        for plan in plans:
+            state.set_applied(plan.member_id, plan.desired)
+        for member_id in absent_ids:
+            state.set_applied(member_id, None)
+        state.fingerprint = fingerprint
+
+        if self.bot.plan_recorder is not None and member_ids:
+            await self.bot.plan_recorder.record(
+                f"{SYNC_NAME}-{guild.id}",
+                {
+                    "sync": SYNC_NAME,
+                    "guild_id": guild.id,
+                    "role_id": role.id,
+                    "game_role_bits": game_role_bits,
+                    "payload": {
+                        member_id: record.games
+                        for member_id, record in mr_records_by_did.items()
+                    },
+                    "members": member_roles_for_recording(member_roles, managed_roles),
+                    "member_ids": sorted(member_ids),
+                },
+                plans,
+            )
+
+        SYNC_PHASE_DURATION.observe(
+            time.perf_counter() - reconcile_start, sync=SYNC_NAME, phase="reconcile"
+        )
+
+        async def finish():
+            state.store_payload(
+                mr_records_by_did,
+                absent_ids,
+                fetched_at,
+                member_ids if incremental else None,
+            )
+            snapshot = self.bot.snapshot
+            if snapshot is not None and (member_ids or not incremental):
+                await snapshot.save(
+                    state, config.guild_id, self.encode_snapshot(state.payload)
+                )
+
+        return finish
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        if member.guild.id in self.states:
+            self.joined.setdefault(member.guild.id, set()).add(member.id)
+
+
+def get_mr_guilds(config):
+    # A single guild can still be configured directly on "mr-sync".
+    mr_sync_config = config["mr-sync"]
+    return [
+        MossrankingGuild.from_config(guild_config)
+        for guild_config in mr_sync_config.get("guilds", [mr_sync_config])
+    ]
+
 
-        for member in guild.members:
-            to_add = []
-            to_remove = []
-            mr_record = mr_records_by_did.get(member.id)
-
-            if mr_record:
-                if role not in member.roles:
-                    logging.info("Adding role %s to user %s", role.name, member.name)
-                    to_add.append(role)
-            else:
-                if role in member.roles:
-                    logging.info(
-                        "Removing role %s from user %s", role.name, member.name
-                    )
-                    to_remove.append(role)
-
-            for game, game_role in game_roles.items():
-                if mr_record:
-                    game_value = mr_record.games.get(game, False)
-                    if game_value and game_role not in member.roles:
-                        logging.info(
-                            "Adding role %s to user %s", game_role.name, member.name
-                        )
-                        to_add.append(game_role)
-                    elif not game_value and game_role in member.roles:
-                        logging.info(
-                            "Removing role %s from user %s", game_role.name, member.name
-                        )
-                        to_remove.append(game_role)
-                else:
-                    if game_role in member.roles:
-                        logging.info(
-                            "Removing role %s from user %s", game_role.name, member.name
-                        )
-                        to_remove.append(game_role)
-
-            if to_add:
-                await member.add_roles(*to_add)
-
-            if to_remove:
-                await member.remove_roles(*to_remove)
-
-    @syncer.before_loop
-    async def before_syncer(self):
-        logging.info("Waiting for bot to be reading before starting sync task...")
-        await self.bot.wait_until_ready()
+def setup(bot):
+    bot.add_cog(MossrankingSync(bot=bot, guilds=get_mr_guilds(bot.config)))
@@ -8,20 +8,20 @@ PRONOUNS_PREFIX = "Pronouns: "
 class Pronouns(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.bot.role_registry.register(PRONOUNS_PREFIX)
 
-    @staticmethod
-    def get_pronouns_roles(roles):
-        pronouns = {}
-        for role in roles:
-            if role.name.startswith(PRONOUNS_PREFIX):
-                pronouns[role.name[len(PRONOUNS_PREFIX) :].lower()] = role
-        return pronouns
+    def get_pronouns_roles(self, guild):
+        return self.bot.role_registry.get(guild, PRONOUNS_PREFIX)
 
     def get_guild_pronouns(self, ctx):
-        return self.get_pronouns_roles(ctx.guild.roles)
+        return self.get_pronouns_roles(ctx.guild)
 
     def get_author_pronouns(self, ctx):
-        return self.get_pronouns_roles(ctx.author.roles)
+        return {
+            name: role
+            for name, role in self.get_pronouns_roles(ctx.guild).items()
+            if ctx.author.get_role(role.id) is not None
+        }
 
     @commands.command(
         help=(
@@ -46,7 +46,9 @@ class Pronouns(commands.Cog):
 
         requested_pronouns = [arg.strip().lower() for arg in args]
         if len(requested_pronouns) == 1 and requested_pronouns[0].lower() == "none":
-            await ctx.author.remove_roles(*self.get_author_pronouns(ctx).values())
+            await self.bot.role_applier.remove_roles(
+                ctx.author, "pronouns", *self.get_author_pronouns(ctx).values()
+            )
             await ctx.message.add_reaction("👍")
             return
 
@@ -73,12 +75,17 @@ class Pronouns(commands.Cog):
             return
 
         # Give requested pronoun roles.
-        await ctx.author.add_roles(*target_pronouns)
+        await self.bot.role_applier.add_roles(ctx.author, "pronouns", *target_pronouns)
 
         # Remove any pronoun roles that weren't specified.
         roles_to_remove = set(self.get_author_pronouns(ctx).values())
         roles_to_remove.difference_update(target_pronouns)
-        if roles_to_remove:
-            await ctx.author.remove_roles(*roles_to_remove)
+        await self.bot.role_applier.remove_roles(
+            ctx.author, "pronouns", *roles_to_remove
+        )
 
         await ctx.message.add_reaction("👍")
+
+
+def setup(bot):
+    bot.add_cog(Pronouns(bot))
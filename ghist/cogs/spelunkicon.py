@@ -109,3 +109,7 @@ class Spelunkicon(commands.Cog):
             url += "&misc=64"
 
         await ctx.send(url)
+
+
+def setup(bot):
+    bot.add_cog(Spelunkicon(bot))
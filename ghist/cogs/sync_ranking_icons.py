@@ -1,30 +1,100 @@
+import asyncio
 import logging
-import os
-from dataclasses import dataclass
-from typing import Dict, List, Optional
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple, Union
 
-import aiohttp
-from discord.ext import commands, tasks
+from discord.ext import commands
+from discord.guild import Guild
 from discord.member import Member
 from discord.role import Role
-from discord.user import User
+
+from ghist.cogs.mr_sync import get_mr_guilds
+from ghist.member_queue import DebouncedMemberQueue
+from ghist.metrics import SYNC_PHASE_DURATION, UNMATCHED_TITLES
+from ghist.mossranking import NotModified, Validators
+from ghist.planner import (
+    SKIP_MISSING_ROLE,
+    SKIP_UNMATCHED_TITLE,
+    get_member_roles,
+    get_pending_changes,
+    member_roles_for_recording,
+    plan_badge_member,
+    plan_members,
+    queue_plans,
+)
+from ghist.role_applier import RoleChanges
+from ghist.scheduler import IntervalTrigger
+from ghist.snapshot import SyncState, get_fingerprint
 
 BADGE_PREFIX = "Badge: "
-MR_SYNC_KEY = os.environ["MR_SYNC_KEY"]
-MR_SYNC_ENDPOINT = "https://mossranking.com/api/getdiscorduserranking.php"
+BADGE_SYNC_PREFIX = "Badge: MR-Sync "
+SYNC_NAME = "icon-sync"
+SYNC_INTERVAL = 300.0
+# Runs that change nothing back off up to this interval. Badge sync role
+# changes are picked up from member updates in the meantime.
+MAX_SYNC_INTERVAL = 1800.0
+# Upper bound on ranking payloads being fetched at the same time.
+MAX_CONCURRENT_FETCHES = 3
+# Upper bound on the distinct titles a matcher remembers.
+MAX_CACHED_TITLES = 4096
 
 
 @dataclass
 class Ranking:
-    contains: str
+    contains: Union[str, List[str]]
     role: str
 
+    @property
+    def needles(self) -> List[str]:
+        if isinstance(self.contains, str):
+            return [self.contains]
+        return self.contains
+
+
+class TitleMatcher:
+    """Resolves Mossranking titles to the first ranking whose needles they contain.
+
+    The rankings are compiled into a single pattern with one lookahead per
+    ranking, tried in order, so the first ranking listed still wins when a
+    title contains needles from several. Results are cached per title since
+    most members share a handful of titles.
+    """
+
+    def __init__(self, rankings: List[Ranking]):
+        self.rankings = rankings
+        alternatives = []
+        for ranking in rankings:
+            needles = "|".join(re.escape(needle) for needle in ranking.needles)
+            alternatives.append(f"(?=.*?({needles}))")
+        self.pattern = re.compile("^(?:{})".format("|".join(alternatives)), re.DOTALL)
+        self._cache = {}
+
+    def match(self, title: str) -> Optional[Ranking]:
+        try:
+            return self._cache[title]
+        except KeyError:
+            pass
+
+        match = self.pattern.match(title)
+        ranking = self.rankings[match.lastindex - 1] if match else None
+
+        if len(self._cache) >= MAX_CACHED_TITLES:
+            self._cache.clear()
+        self._cache[title] = ranking
+        return ranking
+
 
 @dataclass
 class Game:
     ranking_id: int
     role: str
     rankings: List[Ranking]
+    matcher: TitleMatcher = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.matcher = TitleMatcher(self.rankings)
 
 
 GAMES = [
@@ -74,37 +144,54 @@ GAMES = [
 
 
 class MossRankingIconSync(commands.Cog):
-    def __init__(self, bot, guild_id):
+    def __init__(self, bot, guild_ids: List[int]):
         self.bot = bot
-        self.guild_id = guild_id
-
-        self.syncer.start()  # pylint: disable=no-member
+        self.guild_ids = guild_ids
+        self.pending_members = DebouncedMemberQueue(self.sync_members)
+        self.unmatched_titles = set()
+        self.states = {
+            (guild_id, game.ranking_id): SyncState(
+                f"mr-ranking-{game.ranking_id}-{guild_id}"
+            )
+            for guild_id in guild_ids
+            for game in GAMES
+        }
+        # The last titles of each ranking that every guild was reconciled
+        # against, keyed by ranking ID. While Mossranking keeps returning
+        # them only members whose roles changed since are synced.
+        self.validators = {}
+        self.titles = {}
+        self.bot.role_registry.register(BADGE_PREFIX, strip=False)
+        self.bot.role_registry.register(BADGE_SYNC_PREFIX, strip=False)
+
+        self.job = self.bot.scheduler.add_job(
+            SYNC_NAME,
+            self.sync_role_icons,
+            IntervalTrigger(
+                SYNC_INTERVAL, jitter=0.1, backoff=2.0, max_seconds=MAX_SYNC_INTERVAL
+            ),
+        )
+
+    def cog_unload(self):
+        self.pending_members.cancel()
+        self.bot.scheduler.remove_job(SYNC_NAME)
 
     async def get_titles_for_game(
-        self, game: Game, discord_id=None
-    ) -> Optional[Dict[int, int]]:
-
-        params = {
-            "key": MR_SYNC_KEY,
-            "id_ranking": game.ranking_id,
-        }
-        if discord_id is not None:
-            params["discord_id"] = discord_id
+        self, game: Game, discord_id=None, validators: Optional[Validators] = None
+    ) -> Optional[Dict[int, str]]:
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(MR_SYNC_ENDPOINT, params=params) as req:
-                if req.status != 200:
-                    return
-                data = await req.json()
+        with SYNC_PHASE_DURATION.time(sync=SYNC_NAME, phase="fetch"):
+            data = await self.bot.mossranking.get_discord_user_ranking(
+                game.ranking_id, discord_id, validators
+            )
+        if not data:
+            return
 
-        return {int(key): value for key, value in data.items()}
+        with SYNC_PHASE_DURATION.time(sync=SYNC_NAME, phase="parse"):
+            return {int(key): value for key, value in data.items()}
 
     def get_badges_roles(self, guild):
-        roles = {}
-        for role in guild.roles:
-            if role.name.startswith(BADGE_PREFIX):
-                roles[role.name] = role
-        return roles
+        return self.bot.role_registry.get(guild, BADGE_PREFIX)
 
     def get_ranking_roles(self, game: Game, roles: Dict[str, Role]):
         ranking_roles = set()
@@ -115,103 +202,342 @@ class MossRankingIconSync(commands.Cog):
             ranking_roles.add(ranking_role)
         return ranking_roles
 
-    @staticmethod
-    def get_ranking_for_title(title, game: Game) -> Optional[Ranking]:
-        for ranking in game.rankings:
-            if isinstance(ranking.contains, str):
-                needles = [ranking.contains]
-            else:
-                needles = ranking.contains
-
-            for needle in needles:
-                if needle in title:
-                    return ranking
+    async def fetch_titles_for_game(
+        self, semaphore: asyncio.Semaphore, game: Game
+    ) -> Tuple[Game, Optional[Dict[int, str]], Validators, bool]:
+        """Fetch a game's titles and whether they're the last reconciled ones."""
+        validators = self.validators.get(game.ranking_id, Validators()).copy()
+        async with semaphore:
+            try:
+                titles = await self.get_titles_for_game(game, validators=validators)
+            except NotModified:
+                return game, self.titles[game.ranking_id], validators, True
+        return game, titles, validators, False
 
     async def sync_role_icons_for_game(
-        self, members: List[Member], game: Game, roles: Dict[str, Role], discord_id=None
-    ):
+        self,
+        changes: RoleChanges,
+        guild: Guild,
+        game: Game,
+        roles: Dict[str, Role],
+        title_by_discord_id: Optional[Dict[int, str]],
+        member_ids: Optional[Set[int]] = None,
+        incremental: bool = False,
+        pending: Optional[Dict[int, FrozenSet[int]]] = None,
+    ) -> Optional[Set[int]]:
+        """Queue the role changes for one game and return absent member IDs.
+
+        Incremental syncs only look at members whose badge roles changed
+        since the last sync, as `title_by_discord_id` holds the titles that
+        were already reconciled. `pending` maps members to the roles they'll
+        hold after changes already queued on `changes`, which members are
+        planned against instead of their current roles.
+        """
+
+        state = self.states[guild.id, game.ranking_id]
 
         game_sync_role = roles.get(game.role)
         if not game_sync_role:
             return
 
         ranking_roles = self.get_ranking_roles(game, roles)
+        ranking_role_ids = {role.name: role.id for role in ranking_roles}
 
-        title_by_discord_id = await self.get_titles_for_game(game, discord_id)
         # Safety check in case api returns empty data
         if not title_by_discord_id:
             return
 
-        for member in members:
-            title = title_by_discord_id.get(member.id)
-
-            # Don't have a sync role for this game. Make sure to clean up any orphaned roles
-            if game_sync_role not in member.roles or not title:
-                orphaned_roles = ranking_roles.intersection(member.roles)
-                if orphaned_roles:
-                    logging.info(
-                        "Removing roles %s from user %s", orphaned_roles, member.name
+        # Only members whose title or badge roles changed since the last sync
+        # can need changes, unless badge roles or rankings changed since.
+        fingerprint = None
+        if member_ids is None:
+            managed_roles = [game_sync_role, *ranking_roles]
+            self.bot.role_index.track(guild, managed_roles)
+            held_roles = self.bot.role_index.roles_by_member(managed_roles)
+            fingerprint = get_fingerprint(
+                game_sync_role.id,
+                ranking_role_ids,
+                [[ranking.needles, ranking.role] for ranking in game.rankings],
+            )
+            member_ids = state.get_members_to_plan(
+                title_by_discord_id, held_roles, fingerprint, incremental
+            )
+            if pending:
+                member_ids.update(
+                    get_pending_changes(
+                        pending, held_roles, {role.id for role in managed_roles}
                     )
-                    await member.remove_roles(*orphaned_roles)
-                continue
+                )
+            if self.bot.member_fetcher is not None:
+                await self.bot.member_fetcher.fetch(guild, member_ids)
+
+        def plan_member(member_id, held):
+            return plan_badge_member(
+                member_id,
+                held,
+                title_by_discord_id.get(member_id),
+                game_sync_role.id,
+                ranking_role_ids,
+                game.matcher.match,
+            )
 
-            target_ranking = self.get_ranking_for_title(title, game)
-            target_role = roles.get(target_ranking.role)
-            if not target_role:
-                logging.warning("Something went wrong with %s for %s", target_ranking, member.name)
-                continue
+        member_roles = get_member_roles(guild, member_ids, pending)
+        plans, absent_ids = plan_members(member_roles, member_ids, plan_member)
+
+        queue_plans(changes, guild, plans, {role.id: role for role in ranking_roles})
+        for plan in plans:
+            state.set_applied(plan.member_id, plan.desired)
+            if plan.skipped:
+                self.log_skipped_plan(guild, game, plan, title_by_discord_id)
+        for member_id in absent_ids:
+            state.set_applied(member_id, None)
+        if fingerprint is not None:
+            state.fingerprint = fingerprint
+        if incremental:
+            state.store_payload(
+                title_by_discord_id, absent_ids, state.fetched_at, member_ids
+            )
 
-            if target_role not in member.roles:
-                logging.info("Adding role %s to user %s", target_role, member.name)
-                await member.add_roles(target_role)
+        if self.bot.plan_recorder is not None and member_ids:
+            managed_roles = [game_sync_role, *ranking_roles]
+            await self.bot.plan_recorder.record(
+                f"{SYNC_NAME}-{guild.id}-{game.ranking_id}",
+                {
+                    "sync": SYNC_NAME,
+                    "guild_id": guild.id,
+                    "ranking_id": game.ranking_id,
+                    "sync_role_id": game_sync_role.id,
+                    "ranking_role_ids": ranking_role_ids,
+                    "payload": title_by_discord_id,
+                    "members": member_roles_for_recording(member_roles, managed_roles),
+                    "member_ids": sorted(member_ids),
+                },
+                plans,
+            )
 
-            leftover_roles = ranking_roles.difference([target_role]).intersection(
-                member.roles
+        return absent_ids
+
+    def log_skipped_plan(self, guild, game, plan, title_by_discord_id):
+        title = title_by_discord_id[plan.member_id]
+        if plan.skipped == SKIP_UNMATCHED_TITLE:
+            # Titles we don't know how to map leave the member's badges alone
+            # rather than stripping a badge we can't replace.
+            UNMATCHED_TITLES.inc(game=game.role)
+            if title not in self.unmatched_titles:
+                self.unmatched_titles.add(title)
+                logging.warning("No ranking matches title %r for %s", title, game.role)
+        elif plan.skipped == SKIP_MISSING_ROLE:
+            logging.warning(
+                "Missing badge role for title %r in %s", title, guild.name
             )
-            if leftover_roles:
-                logging.info(
-                    "Removing roles %s from user %s", leftover_roles, member.name
-                )
-                await member.remove_roles(*leftover_roles)
 
-    async def sync_role_icons(self, discord_id=None):
-        guild = self.bot.get_guild(self.guild_id)
-        if not guild:
+    @staticmethod
+    def decode_titles_snapshot(body):
+        return {int(discord_id): title for discord_id, title in body.items()}
+
+    async def sync_role_icons(
+        self, member_ids_by_guild: Optional[Dict[int, Set[int]]] = None
+    ):
+        changes_by_guild = {}
+        finish = await self.reconcile(changes_by_guild, member_ids_by_guild)
+        if finish is None:
             return
 
-        if discord_id:
-            members = [guild.get_member(discord_id)]
-        else:
-            members = guild.members
+        await self.bot.role_applier.apply_all(
+            changes_by_guild, source=SYNC_NAME, reason="Mossranking badge sync"
+        )
 
-        roles = self.get_badges_roles(guild=guild)
-        for game in GAMES:
-            logging.info("Syncing for game role: %s", game.role)
-            await self.sync_role_icons_for_game(members, game, roles, discord_id)
+        await finish()
+        return any(changes_by_guild.values())
 
-    @tasks.loop(seconds=300.0)
-    async def syncer(self):
-        await self.sync_role_icons()
+    async def reconcile(
+        self,
+        changes_by_guild: Dict[int, RoleChanges],
+        member_ids_by_guild: Optional[Dict[int, Set[int]]] = None,
+    ):
+        """Queue badge changes onto each guild's `RoleChanges`.
+
+        Changes already queued, such as the game roles planned by the
+        Mossranking sync, are planned on top of so that a member's game
+        role and badges change in a single edit. Returns a coroutine
+        function that stores the sync state once the changes have been
+        applied, or None if there was nothing to sync.
+        """
+        guilds = [
+            guild
+            for guild in map(self.bot.get_guild, self.guild_ids)
+            if guild is not None
+            and (member_ids_by_guild is None or guild.id in member_ids_by_guild)
+        ]
+        if not guilds:
+            return
 
-    @syncer.before_loop
-    async def before_syncer(self):
-        logging.info("Waiting for bot to be ready before starting sync task...")
-        await self.bot.wait_until_ready()
+        snapshot = self.bot.snapshot
+        if snapshot is not None:
+            for guild in guilds:
+                for game in GAMES:
+                    state = self.states[guild.id, game.ranking_id]
+                    if not state.loaded:
+                        await snapshot.load(
+                            state, guild.id, self.decode_titles_snapshot
+                        )
+
+        roles_by_guild = {
+            guild.id: self.get_badges_roles(guild=guild) for guild in guilds
+        }
 
-    @staticmethod
-    def get_badge_sync_roles(roles):
-        badge_sync_roles = set()
-        for role in roles:
-            if role.name.startswith("Badge: MR-Sync "):
-                badge_sync_roles.add(role)
-        return badge_sync_roles
+        # Fetch every game's rankings concurrently, once for all guilds, and
+        # reconcile each one as soon as its payload arrives rather than
+        # waiting on the slowest. Changes are merged across games and
+        # applied once per member.
+        pending_by_guild = {}
+        for guild in guilds:
+            changes = changes_by_guild.setdefault(guild.id, RoleChanges())
+            pending_by_guild[guild.id] = changes.get_final_role_ids()
+        reconciled = []
+        fetched = []
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+        fetches = [
+            asyncio.ensure_future(self.fetch_titles_for_game(semaphore, game))
+            for game in GAMES
+            if any(game.role in roles for roles in roles_by_guild.values())
+        ]
+        try:
+            for fetch in asyncio.as_completed(fetches):
+                game, fetched_titles, validators, unchanged = await fetch
+                if unchanged:
+                    logging.info("Rankings unchanged for game role: %s", game.role)
+                synced_all = True
+                for guild in guilds:
+                    roles = roles_by_guild[guild.id]
+                    if game.role not in roles:
+                        continue
+
+                    state = self.states[guild.id, game.ranking_id]
+                    title_by_discord_id = fetched_titles
+                    fetched_at = time.time()
+                    if not title_by_discord_id and state.payload and state.is_fresh():
+                        logging.warning("Falling back to snapshot of %s", state.scope)
+                        title_by_discord_id = state.payload
+                        fetched_at = state.fetched_at
+
+                    member_ids = None
+                    if member_ids_by_guild is not None:
+                        member_ids = member_ids_by_guild[guild.id]
+
+                    logging.info("Syncing %s for game role: %s", guild.name, game.role)
+                    with SYNC_PHASE_DURATION.time(sync=SYNC_NAME, phase="reconcile"):
+                        absent_ids = await self.sync_role_icons_for_game(
+                            changes_by_guild[guild.id],
+                            guild,
+                            game,
+                            roles,
+                            title_by_discord_id,
+                            member_ids,
+                            incremental=unchanged and member_ids is None,
+                            pending=pending_by_guild[guild.id],
+                        )
+                    if absent_ids is None:
+                        synced_all = False
+                    elif member_ids is None and not unchanged:
+                        reconciled.append(
+                            (guild, state, title_by_discord_id, absent_ids, fetched_at)
+                        )
+
+                # Titles only count as reconciled once a full sync of every
+                # guild got through them.
+                if (
+                    member_ids_by_guild is None
+                    and fetched_titles
+                    and not unchanged
+                    and synced_all
+                ):
+                    fetched.append((game, fetched_titles, validators))
+        finally:
+            # Fetches still running when reconciling a game failed are
+            # cancelled rather than left in flight.
+            for task in fetches:
+                task.cancel()
+            await asyncio.gather(*fetches, return_exceptions=True)
+
+        async def finish():
+            for guild, state, titles, absent_ids, fetched_at in reconciled:
+                state.store_payload(titles, absent_ids, fetched_at)
+                if snapshot is not None:
+                    await snapshot.save(
+                        state,
+                        guild.id,
+                        {
+                            str(discord_id): title
+                            for discord_id, title in state.payload.items()
+                        },
+                    )
+
+            for game, titles, validators in fetched:
+                self.titles[game.ranking_id] = titles
+                self.validators[game.ranking_id] = validators
+
+        return finish
+
+    async def sync_members(self, members: Set[Tuple[int, int]]):
+        member_ids_by_guild = {}
+        for guild_id, member_id in members:
+            member_ids_by_guild.setdefault(guild_id, set()).add(member_id)
+
+        # Share the job's lock so a partial sync never overlaps a full one.
+        async with self.job.lock:
+            await self.sync_role_icons(member_ids_by_guild)
+
+    def get_badge_sync_roles(self, member):
+        return {
+            role
+            for role in self.bot.role_registry.get(
+                member.guild, BADGE_SYNC_PREFIX
+            ).values()
+            if member.get_role(role.id) is not None
+        }
+
+    def is_badge_role(self, role):
+        return role.guild.id in self.guild_ids and role.name.startswith(BADGE_PREFIX)
+
+    # Badges are planned against the badge roles that exist, so the sync runs
+    # again right away rather than once it's next due.
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        if self.is_badge_role(role):
+            self.job.run_now()
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        if before.name != after.name and (
+            self.is_badge_role(before) or self.is_badge_role(after)
+        ):
+            self.job.run_now()
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        if self.is_badge_role(role):
+            self.job.run_now()
 
     @commands.Cog.listener()
-    async def on_member_update(self, before: User, after: User):
-        before_badge_sync_roles = self.get_badge_sync_roles(before.roles)
-        after_badge_sync_roles = self.get_badge_sync_roles(after.roles)
+    async def on_member_update(self, before: Member, after: Member):
+        if after.guild.id not in self.guild_ids:
+            return
+
+        # Edits made by the bot are already reconciled by the sync that made
+        # them and would otherwise cascade into a sync per edited member.
+        if self.bot.role_applier.is_own_edit(after):
+            return
+
+        before_badge_sync_roles = self.get_badge_sync_roles(before)
+        after_badge_sync_roles = self.get_badge_sync_roles(after)
 
         if before_badge_sync_roles == after_badge_sync_roles:
             return
 
-        await self.sync_role_icons(after.id)
+        self.pending_members.put((after.guild.id, after.id))
+
+
+def setup(bot):
+    guild_ids = [mr_guild.guild_id for mr_guild in get_mr_guilds(bot.config)]
+    bot.add_cog(MossRankingIconSync(bot=bot, guild_ids=guild_ids))
@@ -63,3 +63,7 @@ class Ushabti(commands.Cog):
                 adjectives[type_] = random.choice(TYPE_TO_ADJECTIVES[type_])
 
         await ctx.send(USHABTI_URL.format(**adjectives))
+
+
+def setup(bot):
+    bot.add_cog(Ushabti(bot))
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+from ghist.metrics import MEMBER_LOOKUPS
+
+# Most user IDs the gateway accepts in one member request.
+QUERY_BATCH_SIZE = 100
+
+
+class MemberFetcher:
+    """Fetches members missing from a guild's member cache on demand.
+
+    With a minimal member cache the bot only holds members it has looked
+    up, so syncs ask for the members they are about to reconcile and these
+    are requested from the gateway in batches and cached from then on.
+    Members that turn out not to be in the guild are remembered so they
+    aren't requested again until they join.
+    """
+
+    def __init__(self, role_index, batch_size=QUERY_BATCH_SIZE):
+        self.role_index = role_index
+        self.batch_size = batch_size
+        self._absent = {}
+
+    def clear(self):
+        self._absent.clear()
+
+    def add_member(self, member):
+        absent = self._absent.get(member.guild.id)
+        if absent is not None:
+            absent.discard(member.id)
+
+    def remove_guild(self, guild):
+        self._absent.pop(guild.id, None)
+
+    async def fetch(self, guild, member_ids):
+        absent = self._absent.setdefault(guild.id, set())
+        missing = [
+            member_id
+            for member_id in member_ids
+            if member_id not in absent and guild.get_member(member_id) is None
+        ]
+
+        for idx in range(0, len(missing), self.batch_size):
+            batch = missing[idx : idx + self.batch_size]
+            try:
+                members = await guild.query_members(
+                    user_ids=batch, limit=len(batch), cache=True
+                )
+            except asyncio.TimeoutError:
+                logging.warning(
+                    "Timed out fetching %s members of %s", len(batch), guild.name
+                )
+                continue
+
+            found = set()
+            for member in members:
+                found.add(member.id)
+                self.role_index.add_member(member)
+            absent.update(member_id for member_id in batch if member_id not in found)
+
+            MEMBER_LOOKUPS.inc(len(found), result="found")
+            MEMBER_LOOKUPS.inc(len(batch) - len(found), result="absent")
+
+        if missing:
+            logging.info("Fetched %s uncached members of %s", len(missing), guild.name)
@@ -0,0 +1,43 @@
+import asyncio
+import logging
+
+DEBOUNCE_DELAY = 5.0
+
+
+class DebouncedMemberQueue:
+    """Collects member IDs and hands them to `callback` in batches.
+
+    The first ID queued opens a debounce window; everything queued until
+    the window closes is deduplicated and passed to `callback` as a single
+    set, so a burst of events for the same or different members results
+    in one call rather than one per event.
+    """
+
+    def __init__(self, callback, delay=DEBOUNCE_DELAY):
+        self.callback = callback
+        self.delay = delay
+        self._pending = set()
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, member_id):
+        self._pending.add(member_id)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._drain())
+
+    async def _drain(self):
+        while self._pending:
+            await asyncio.sleep(self.delay)
+            batch, self._pending = self._pending, set()
+            try:
+                await self.callback(batch)
+            except Exception:
+                logging.exception("Failed to process queued members %s", batch)
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._pending.clear()
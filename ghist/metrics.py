@@ -0,0 +1,260 @@
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTE_BUCKETS = (1024, 4096, 16384, 32768, 65536, 131072, 262144, 524288, 1048576)
+SYNC_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+LAG_INTERVAL = 1.0
+
+METRICS = []
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric:
+    """Base for the minimal in-process metrics rendered in Prometheus format."""
+
+    type_name = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type_name}"
+        for key, value in self._values.items():
+            yield f"{self.name}{format_labels(self.label_names, key)} {value}"
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get_values(self):
+        """Current values keyed by their tuple of label values."""
+        return dict(self._values)
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            # One count per bucket plus +Inf, then the running sum.
+            counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type_name}"
+        for key, counts in self._values.items():
+            cumulative = 0
+            bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = format_labels(self.label_names, key, [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {counts[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+COMMAND_DURATION = Histogram(
+    "ghist_command_duration_seconds",
+    "Time taken to run a bot command, including checks.",
+    ["cog", "command"],
+)
+SYNC_PHASE_DURATION = Histogram(
+    "ghist_sync_phase_duration_seconds",
+    "Time spent in each phase of a sync run.",
+    ["sync", "phase"],
+    buckets=SYNC_BUCKETS,
+)
+SYNC_LAST_DURATION = Gauge(
+    "ghist_sync_last_duration_seconds",
+    "Duration of the most recent run of a sync.",
+    ["sync"],
+)
+SYNC_INTERVAL = Gauge(
+    "ghist_sync_interval_seconds",
+    "Configured interval between runs of a sync.",
+    ["sync"],
+)
+SYNC_LAST_RUN = Gauge(
+    "ghist_sync_last_run_timestamp_seconds",
+    "Unix time the most recent run of a sync finished.",
+    ["sync"],
+)
+ROLE_MUTATIONS = Counter(
+    "ghist_role_mutations_total",
+    "Role mutation requests sent to Discord.",
+    ["source", "action"],
+)
+ROLE_MUTATION_FAILURES = Counter(
+    "ghist_role_mutation_failures_total",
+    "Role mutation requests that Discord rejected.",
+    ["source"],
+)
+UNMATCHED_TITLES = Counter(
+    "ghist_unmatched_titles_total",
+    "Ranking titles that didn't match any badge for their game.",
+    ["game"],
+)
+MUTATION_WAIT = Histogram(
+    "ghist_mutation_wait_seconds",
+    "Time role mutations waited for the rate limiter by lane.",
+    ["lane"],
+)
+PALETTE_IMAGE_BYTES = Histogram(
+    "ghist_palette_image_bytes",
+    "Size of rendered color palette images by format.",
+    ["format"],
+    buckets=BYTE_BUCKETS,
+)
+MOSSRANKING_REQUEST_DURATION = Histogram(
+    "ghist_mossranking_request_duration_seconds",
+    "Latency of Mossranking api requests by response status.",
+    ["endpoint", "status"],
+)
+MEMBER_LOOKUPS = Counter(
+    "ghist_member_lookups_total",
+    "Uncached members requested from the gateway by whether they were found.",
+    ["result"],
+)
+REACTION_QUEUE_DEPTH = Gauge(
+    "ghist_reaction_queue_depth",
+    "Reactions waiting to be sent.",
+)
+REACTIONS = Counter(
+    "ghist_reactions_total",
+    "Queued reactions by whether they were sent, failed or dropped.",
+    ["result"],
+)
+STARTUP_PHASE_DURATION = Gauge(
+    "ghist_startup_phase_duration_seconds",
+    "Time spent in each phase of bot startup.",
+    ["phase"],
+)
+COG_BUSY_SECONDS = Counter(
+    "ghist_cog_busy_seconds_total",
+    "Time the event loop spent running tasks started by each cog.",
+    ["cog"],
+)
+COG_EVENT_DURATION = Histogram(
+    "ghist_cog_event_duration_seconds",
+    "Wall time of cog event listeners.",
+    ["cog", "event"],
+)
+SLOW_CALLBACKS = Counter(
+    "ghist_slow_callbacks_total",
+    "Times the event loop was blocked for longer than the watchdog threshold.",
+)
+EVENT_LOOP_LAG = Histogram(
+    "ghist_event_loop_lag_seconds",
+    "How late the event loop woke up a sleeping task.",
+)
+
+
+@contextmanager
+def sync_run(sync, interval):
+    """Record the duration of one run of a periodic sync."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SYNC_LAST_DURATION.set(time.perf_counter() - start, sync=sync)
+        SYNC_INTERVAL.set(interval, sync=sync)
+        SYNC_LAST_RUN.set(time.time(), sync=sync)
+
+
+async def monitor_event_loop_lag(interval=LAG_INTERVAL):
+    loop = asyncio.get_event_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - expected))
+
+
+class MetricsServer:
+    """Serves the collected metrics on /metrics and tracks event loop lag."""
+
+    def __init__(self, host="127.0.0.1", port=9102):
+        self.host = host
+        self.port = port
+        self._runner = None
+        self._lag_task = None
+
+    async def handle_metrics(self, request):
+        return web.Response(
+            text=render_metrics(), content_type="text/plain", charset="utf-8"
+        )
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._lag_task = asyncio.ensure_future(monitor_event_loop_lag())
+        logging.info("Serving metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def close(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,260 @@
+import asyncio
+import codecs
+import dataclasses
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import aiohttp
+
+from ghist.metrics import MOSSRANKING_REQUEST_DURATION
+
+MR_API_BASE = "https://mossranking.com/api/"
+MR_USERS_ENDPOINT = "getdiscordusers.php"
+MR_RANKING_ENDPOINT = "getdiscorduserranking.php"
+
+# Connection pool and timeout settings for the shared client. The api
+# is only ever hit by a handful of sync tasks so a small pool is plenty.
+POOL_SIZE = 4
+KEEPALIVE_TIMEOUT = 120.0
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 60.0
+STREAM_CHUNK_SIZE = 64 * 1024
+JSON_WHITESPACE = " \t\n\r"
+# Characters that can follow an array element.
+JSON_ELEMENT_END = JSON_WHITESPACE + ",]"
+# Bodies are small enough that compression always pays off.
+ACCEPT_ENCODING = "gzip, deflate"
+
+
+class MossrankingError(Exception):
+    pass
+
+
+class NotModified(Exception):
+    """Mossranking has nothing newer than the payload the validators describe."""
+
+
+@dataclass
+class Validators:
+    """Describes a payload so that a later fetch can tell if it changed.
+
+    The ETag and Last-Modified of the response are sent back as
+    conditional request headers when Mossranking provides them, and the
+    digest of the body catches identical payloads when it doesn't. A
+    request updates the validators it was given in place to describe the
+    response it got.
+    """
+
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    digest: Optional[str] = None
+
+    def copy(self):
+        return dataclasses.replace(self)
+
+    def get_headers(self):
+        headers = {"Accept-Encoding": ACCEPT_ENCODING}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def update(self, response, digest):
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        self.digest = digest
+
+
+def get_digest():
+    return hashlib.blake2b(digest_size=16)
+
+
+async def iter_json_array(chunks):
+    """Incrementally decode the elements of a top-level JSON array.
+
+    `chunks` is an async iterable of bytes. Each element is yielded as soon
+    as it has been fully received so the whole document is never held in
+    memory at once.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    started = False
+    finished = False
+
+    async for chunk in chunks:
+        buf += text_decoder.decode(chunk)
+        pos = 0
+        while pos < len(buf):
+            char = buf[pos]
+            if char in JSON_WHITESPACE:
+                pos += 1
+            elif not started:
+                if char != "[":
+                    raise MossrankingError("Expected a JSON array")
+                started = True
+                pos += 1
+            elif char == ",":
+                pos += 1
+            elif char == "]":
+                finished = True
+                break
+            else:
+                try:
+                    element, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # Most likely an element split across chunks.
+                    break
+                # A number cut off at the end of a chunk decodes as a shorter
+                # number, as in `12` from `12.5` or `1` from `1e3`, so
+                # elements are only complete once something follows them.
+                if end == len(buf) or buf[end] not in JSON_ELEMENT_END:
+                    break
+                pos = end
+                yield element
+
+        if finished:
+            return
+        buf = buf[pos:]
+
+    raise MossrankingError("Truncated JSON array")
+
+
+class MossrankingClient:
+    """Long-lived HTTP client shared by every cog talking to Mossranking.
+
+    The underlying session is created lazily on first use so that it is
+    bound to the running event loop, and is reused between sync runs so
+    connections stay alive instead of paying a new handshake every call.
+    """
+
+    def __init__(self, key, base_url=MR_API_BASE):
+        self.key = key
+        self.base_url = base_url
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=POOL_SIZE,
+                limit_per_host=POOL_SIZE,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+            )
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=timeout
+            )
+        return self._session
+
+    async def _get_json(self, endpoint, params, validators=None):
+        """Fetch and decode a JSON payload, or return None if that fails.
+
+        With `validators` the request is made conditional, and `NotModified`
+        is raised if Mossranking says the payload is unchanged or the body
+        turns out to be identical to the one they describe.
+        """
+        url = self.base_url + endpoint
+        session = self._get_session()
+        params = dict(params, key=self.key)
+        if validators is None:
+            validators = Validators()
+        status = "error"
+        start = time.perf_counter()
+        try:
+            async with session.get(
+                url, params=params, headers=validators.get_headers()
+            ) as req:
+                status = req.status
+                if req.status == 304:
+                    raise NotModified()
+                if req.status != 200:
+                    logging.warning("Mossranking returned %s for %s", req.status, url)
+                    return
+                body = await req.read()
+                digest = get_digest()
+                digest.update(body)
+                previous_digest = validators.digest
+                validators.update(req, digest.hexdigest())
+                if validators.digest == previous_digest:
+                    raise NotModified()
+                return json.loads(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            status = "error"
+            logging.warning("Failed to fetch %s: %r", url, err)
+            return
+        except ValueError as err:
+            logging.warning("Failed to decode %s: %r", url, err)
+            return
+        finally:
+            MOSSRANKING_REQUEST_DURATION.observe(
+                time.perf_counter() - start, endpoint=endpoint, status=status
+            )
+
+    async def iter_discord_users(self, validators=None):
+        """Stream the getdiscordusers payload one user record at a time.
+
+        Raises `MossrankingError` if the payload can't be fetched or is cut
+        short, so callers never act on a partial user list. With
+        `validators` the request is made conditional and raises
+        `NotModified` if Mossranking says the payload is unchanged. As the
+        body is only fully hashed once it has been streamed, `validators`
+        are updated after the last record and callers compare digests
+        themselves.
+        """
+        url = self.base_url + MR_USERS_ENDPOINT
+        session = self._get_session()
+        if validators is None:
+            validators = Validators()
+        status = "error"
+        start = time.perf_counter()
+        try:
+            async with session.get(
+                url, params={"key": self.key}, headers=validators.get_headers()
+            ) as req:
+                if req.status == 304:
+                    status = req.status
+                    raise NotModified()
+                if req.status != 200:
+                    status = req.status
+                    raise MossrankingError(f"Mossranking returned {req.status}")
+                digest = get_digest()
+
+                async def iter_chunks():
+                    async for chunk in req.content.iter_chunked(STREAM_CHUNK_SIZE):
+                        digest.update(chunk)
+                        yield chunk
+
+                async for user in iter_json_array(iter_chunks()):
+                    yield user
+                # Anything after the closing bracket still counts towards
+                # the digest.
+                digest.update(await req.read())
+                validators.update(req, digest.hexdigest())
+                status = req.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise MossrankingError(f"Failed to fetch {url}: {err!r}") from err
+        finally:
+            # Includes the time the caller spends on each streamed record.
+            MOSSRANKING_REQUEST_DURATION.observe(
+                time.perf_counter() - start, endpoint=MR_USERS_ENDPOINT, status=status
+            )
+
+    async def get_discord_user_ranking(
+        self, ranking_id, discord_id=None, validators=None
+    ):
+        params = {"id_ranking": ranking_id}
+        if discord_id is not None:
+            params["discord_id"] = discord_id
+        return await self._get_json(MR_RANKING_ENDPOINT, params, validators)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
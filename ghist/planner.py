@@ -0,0 +1,228 @@
+"""Pure role planning for the Mossranking syncs.
+
+Planners only look at role IDs and payload data and return the role
+mutations a sync should make, without touching Discord. That lets them be
+run against recorded inputs offline, see `bench.replay`.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+EMPTY_ROLES = frozenset()
+
+# Reasons a planner can leave a member's roles alone.
+SKIP_UNMATCHED_TITLE = "unmatched-title"
+SKIP_MISSING_ROLE = "missing-role"
+
+
+@dataclass(frozen=True)
+class RolePlan:
+    member_id: int
+    # Managed roles the member should hold once the plan is applied.
+    desired: FrozenSet[int]
+    add: FrozenSet[int] = EMPTY_ROLES
+    remove: FrozenSet[int] = EMPTY_ROLES
+    skipped: Optional[str] = None
+
+    def to_dict(self):
+        data = {
+            "member_id": self.member_id,
+            "desired": sorted(self.desired),
+            "add": sorted(self.add),
+            "remove": sorted(self.remove),
+        }
+        if self.skipped:
+            data["skipped"] = self.skipped
+        return data
+
+
+def make_plan(member_id, held, desired, managed, skipped=None):
+    """Plan for a member to hold `desired` out of their `managed` roles."""
+    held = held & managed
+    return RolePlan(
+        member_id=member_id,
+        desired=frozenset(desired),
+        add=frozenset(desired - held),
+        remove=frozenset(held - desired),
+        skipped=skipped,
+    )
+
+
+def plan_mossranking_member(
+    member_id: int,
+    held: FrozenSet[int],
+    games: Optional[int],
+    role_id: int,
+    game_role_bits: Dict[int, int],
+) -> RolePlan:
+    """Plan the linked and per-game roles of one member.
+
+    `games` is the member's Mossranking game bitmask, or None if they
+    aren't linked, and `game_role_bits` maps game role IDs to their bit.
+    """
+    managed = {role_id, *game_role_bits}
+    desired = set()
+    if games is not None:
+        desired.add(role_id)
+        desired.update(
+            game_role_id for game_role_id, bit in game_role_bits.items() if games & bit
+        )
+    return make_plan(member_id, held, desired, managed)
+
+
+def plan_badge_member(
+    member_id: int,
+    held: FrozenSet[int],
+    title: Optional[str],
+    sync_role_id: int,
+    ranking_role_ids: Dict[str, int],
+    match: Callable,
+) -> RolePlan:
+    """Plan the ranking badge of one member for a single game.
+
+    Members without the game's sync role or a title lose their badges.
+    `match` resolves a title to its ranking, and titles that don't resolve
+    to an existing role leave the member's badges as they are.
+    """
+    has_sync_role = sync_role_id in held
+    # The sync role is only ever kept, never added or removed.
+    managed = {sync_role_id, *ranking_role_ids.values()}
+    desired = {sync_role_id} if has_sync_role else set()
+
+    if not has_sync_role or not title:
+        return make_plan(member_id, held, desired, managed)
+
+    ranking = match(title)
+    skipped = None
+    if ranking is None:
+        skipped = SKIP_UNMATCHED_TITLE
+    elif ranking.role not in ranking_role_ids:
+        skipped = SKIP_MISSING_ROLE
+    if skipped:
+        desired.update(held & managed)
+        return make_plan(member_id, held, desired, managed, skipped=skipped)
+
+    desired.add(ranking_role_ids[ranking.role])
+    return make_plan(member_id, held, desired, managed)
+
+
+def plan_members(
+    member_roles: Dict[int, FrozenSet[int]],
+    member_ids: Iterable[int],
+    plan_member: Callable[[int, FrozenSet[int]], RolePlan],
+) -> Tuple[List[RolePlan], Set[int]]:
+    """Plan every member in `member_ids` and return the plans and absent IDs.
+
+    `member_roles` maps the IDs of members in the guild to the IDs of the
+    roles they hold. Members missing from it are reported as absent.
+    """
+    plans = []
+    absent_ids = set()
+    for member_id in member_ids:
+        held = member_roles.get(member_id)
+        if held is None:
+            absent_ids.add(member_id)
+            continue
+        plans.append(plan_member(member_id, held))
+    return plans, absent_ids
+
+
+def get_member_roles(guild, member_ids, pending=None):
+    """Role IDs held by each of `member_ids` that is cached in `guild`.
+
+    `pending` maps member IDs to the role IDs they will hold once changes
+    that are already queued for them are applied, and takes precedence.
+    """
+    member_roles = {}
+    for member_id in member_ids:
+        member = guild.get_member(member_id)
+        if member is None:
+            continue
+        if pending is not None and member_id in pending:
+            member_roles[member_id] = pending[member_id]
+        else:
+            member_roles[member_id] = frozenset(role.id for role in member.roles)
+    return member_roles
+
+
+def get_pending_changes(pending, held_roles, managed):
+    """IDs of members whose queued changes touch any of the `managed` roles."""
+    return {
+        member_id
+        for member_id, role_ids in pending.items()
+        if role_ids & managed != held_roles.get(member_id, EMPTY_ROLES)
+    }
+
+
+def save_recording(path, recording):
+    with open(path, "w") as recording_file:
+        json.dump(recording, recording_file)
+
+
+def load_recording(path):
+    with open(path) as recording_file:
+        return json.load(recording_file)
+
+
+def queue_plans(changes, guild, plans, roles_by_id):
+    """Queue the mutations of `plans` onto `changes` for members of `guild`."""
+    for plan in plans:
+        if not plan.add and not plan.remove:
+            continue
+
+        member = guild.get_member(plan.member_id)
+        to_add = [roles_by_id[role_id] for role_id in plan.add]
+        to_remove = [roles_by_id[role_id] for role_id in plan.remove]
+        if to_add:
+            logging.info(
+                "Adding roles %s to user %s",
+                ", ".join(role.name for role in to_add),
+                member.name,
+            )
+            changes.add(member, *to_add)
+        if to_remove:
+            logging.info(
+                "Removing roles %s from user %s",
+                ", ".join(role.name for role in to_remove),
+                member.name,
+            )
+            changes.remove(member, *to_remove)
+
+
+class PlanRecorder:
+    """Writes the inputs and resulting plan of each sync run to a directory.
+
+    Recordings can be replayed offline with `bench.replay` to profile the
+    planners or compare their output across changes. Files are named after
+    the sync, the time and a sequence number, since several runs can be
+    recorded within the same second.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._sequence = itertools.count()
+
+    async def record(self, name, recording, plans):
+        recording = dict(recording, plan=[plan.to_dict() for plan in plans])
+        path = self.directory / "{}-{}-{:06}.json".format(
+            name, time.strftime("%Y%m%dT%H%M%S", time.gmtime()), next(self._sequence)
+        )
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, save_recording, path, recording)
+        except OSError:
+            logging.exception("Failed to record plan to %s", path)
+
+
+def member_roles_for_recording(member_roles, managed_roles):
+    # Only managed roles affect a plan, so recordings leave the rest out.
+    managed = {role.id for role in managed_roles}
+    return {
+        member_id: sorted(held & managed) for member_id, held in member_roles.items()
+    }
@@ -0,0 +1,209 @@
+"""Opt-in tools for finding out what is keeping the event loop busy.
+
+None of these need the event loop to be in debug mode. The watchdog and
+the sampling profiler run on their own threads and only look at the loop
+thread's current stack, and cog accounting wraps each task's coroutine to
+time the steps it runs on the loop.
+"""
+import asyncio
+import collections.abc
+import contextvars
+import functools
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+
+from ghist.metrics import COG_BUSY_SECONDS, COG_EVENT_DURATION, SLOW_CALLBACKS
+
+# Tasks that weren't started from a cog are accounted to the bot itself.
+CURRENT_COG = contextvars.ContextVar("current_cog", default="bot")
+SAMPLE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 120
+
+
+@contextmanager
+def cog_context(cog):
+    """Account the loop time of everything run inside to `cog`.
+
+    Tasks started inside inherit the cog, so work a cog fans out into
+    other tasks is still accounted to it.
+    """
+    token = CURRENT_COG.set(cog)
+    try:
+        yield
+    finally:
+        CURRENT_COG.reset(token)
+
+
+def get_owner_name(callback):
+    """Name of the cog a bound method belongs to, if any."""
+    owner = getattr(callback, "__self__", None)
+    return getattr(owner, "qualified_name", None)
+
+
+def track_listener(listener, cog, event):
+    """Wrap a cog's event listener to account its time to the cog."""
+
+    @functools.wraps(listener)
+    async def wrapper(*args, **kwargs):
+        with cog_context(cog), COG_EVENT_DURATION.time(cog=cog, event=event):
+            await listener(*args, **kwargs)
+
+    return wrapper
+
+
+class TimedCoroutine(collections.abc.Coroutine):
+    """Proxies a task's coroutine, timing each step it runs on the loop."""
+
+    __slots__ = ("_coro",)
+
+    def __init__(self, coro):
+        self._coro = coro
+
+    def send(self, value):
+        start = time.perf_counter()
+        try:
+            return self._coro.send(value)
+        finally:
+            COG_BUSY_SECONDS.inc(time.perf_counter() - start, cog=CURRENT_COG.get())
+
+    def throw(self, typ, val=None, tb=None):
+        start = time.perf_counter()
+        try:
+            return self._coro.throw(typ, val, tb)
+        finally:
+            COG_BUSY_SECONDS.inc(time.perf_counter() - start, cog=CURRENT_COG.get())
+
+    def close(self):
+        return self._coro.close()
+
+    def __await__(self):
+        return self._coro.__await__()
+
+
+def task_factory(loop, coro):
+    return asyncio.Task(TimedCoroutine(coro), loop=loop)
+
+
+def enable_cog_accounting(loop):
+    """Time the steps of every task created on `loop` from now on."""
+    loop.set_task_factory(task_factory)
+
+
+def get_frame_name(code):
+    return f"{code.co_filename}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread and counts identical stacks.
+
+    The result is rendered as collapsed stacks, one `frame;frame;... count`
+    line per distinct stack, as read by flame graph tools.
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            # Stacks are keyed by code objects and only named when rendered.
+            self.samples[tuple(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._sample, name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def total(self):
+        return sum(self.samples.values())
+
+    def render(self):
+        lines = []
+        for stack, count in self.samples.most_common():
+            lines.append(
+                "{} {}".format(";".join(get_frame_name(code) for code in stack), count)
+            )
+        return "\n".join(lines) + "\n"
+
+
+class LoopWatchdog:
+    """Logs the loop thread's stack whenever the loop is blocked too long.
+
+    A task on the loop keeps bumping a heartbeat and a watcher thread
+    checks on it. When the heartbeat is late by more than `threshold`
+    seconds, whatever is running on the loop at that moment is logged.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._beat_interval = threshold / 2
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._reported = False
+        self._beat_task = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    async def _beat(self):
+        while True:
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self._beat_interval)
+
+    def _watch(self):
+        while not self._stop.wait(self.threshold / 4):
+            blocked = time.monotonic() - self._last_beat - self._beat_interval
+            if blocked <= self.threshold:
+                self._reported = False
+                continue
+            # Only the first check of a stall captures the stack.
+            if self._reported:
+                continue
+            self._reported = True
+
+            SLOW_CALLBACKS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            logging.warning(
+                "Event loop blocked for over %.3fs, currently running:\n%s",
+                blocked,
+                stack,
+            )
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._beat_task = asyncio.ensure_future(self._beat())
+        self._thread = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._thread.start()
+        logging.info("Logging event loop stalls longer than %.3fs", self.threshold)
+
+    def close(self):
+        if self._beat_task is not None:
+            self._beat_task.cancel()
+            self._beat_task = None
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
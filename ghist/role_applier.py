@@ -0,0 +1,334 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import discord
+
+from ghist.metrics import (
+    MUTATION_WAIT,
+    ROLE_MUTATION_FAILURES,
+    ROLE_MUTATIONS,
+    SYNC_PHASE_DURATION,
+)
+
+# Defaults for bulk role edits. Discord puts every member edit in a guild
+# into the same rate-limit bucket, so these are kept conservative and
+# py-cord's own bucket handling takes care of anything that slips past.
+EDIT_CONCURRENCY = 5
+EDIT_RATE = 5
+EDIT_PER = 1.0
+PROGRESS_INTERVAL = 30.0
+# How long an applied edit is remembered for recognising its member update.
+OWN_EDIT_TTL = 60.0
+
+# Lanes of the mutation rate limiter, highest priority first.
+LANE_INTERACTIVE = "interactive"
+LANE_BACKGROUND = "background"
+LANES = (LANE_INTERACTIVE, LANE_BACKGROUND)
+
+
+class RateLimiter:
+    """Simple token bucket allowing `rate` acquisitions every `per` seconds."""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.rate, self.tokens + (now - self.updated) * (self.rate / self.per)
+        )
+        self.updated = now
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) * (self.per / self.rate))
+                self._refill()
+            self.tokens -= 1
+
+
+class PriorityRateLimiter(RateLimiter):
+    """Token bucket shared by several lanes and served in priority order.
+
+    Whenever acquisitions have to wait for tokens, waiters in an earlier
+    lane are always let through before any in a later one, so interactive
+    work only ever waits for the next token rather than behind a backlog
+    of background work.
+    """
+
+    def __init__(self, rate, per, lanes=LANES):
+        super().__init__(rate, per)
+        self.lanes = lanes
+        self._waiters = {lane: deque() for lane in lanes}
+        self._dispatcher = None
+
+    def _next_waiters(self, last_lane=None):
+        for lane in self.lanes:
+            waiters = self._waiters[lane]
+            # Waiters whose acquisition was cancelled are skipped.
+            while waiters and waiters[0].done():
+                waiters.popleft()
+            if waiters:
+                return waiters
+            if lane == last_lane:
+                break
+        return None
+
+    async def _dispatch(self):
+        while True:
+            waiters = self._next_waiters()
+            if waiters is None:
+                return
+
+            self._refill()
+            if self.tokens < 1:
+                # Look for the highest priority waiter again after sleeping
+                # as a more important one may have arrived in the meantime.
+                await asyncio.sleep((1 - self.tokens) * (self.per / self.rate))
+                continue
+
+            self.tokens -= 1
+            waiters.popleft().set_result(None)
+
+    async def acquire(self, lane=LANE_BACKGROUND):
+        start = time.monotonic()
+        try:
+            if self._next_waiters(last_lane=lane) is None:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters[lane].append(waiter)
+            if self._dispatcher is None or self._dispatcher.done():
+                self._dispatcher = asyncio.ensure_future(self._dispatch())
+            await waiter
+        finally:
+            MUTATION_WAIT.observe(time.monotonic() - start, lane=lane)
+
+
+class RoleChanges:
+    """Accumulates role additions and removals per member.
+
+    Changes for the same member are merged so that they can later be
+    applied with a single edit.
+    """
+
+    def __init__(self):
+        self._changes = {}
+
+    def _get(self, member):
+        key = (member.guild.id, member.id)
+        if key not in self._changes:
+            self._changes[key] = (member, set(), set())
+        return self._changes[key]
+
+    def add(self, member, *roles):
+        _, to_add, to_remove = self._get(member)
+        to_add.update(roles)
+        to_remove.difference_update(roles)
+
+    def remove(self, member, *roles):
+        _, to_add, to_remove = self._get(member)
+        to_remove.update(roles)
+        to_add.difference_update(roles)
+
+    def get_final_role_ids(self):
+        """Map each changed member's ID to the role IDs they'll hold after."""
+        final = {}
+        for member, to_add, to_remove in self._changes.values():
+            role_ids = {role.id for role in member.roles}
+            role_ids.difference_update(role.id for role in to_remove)
+            role_ids.update(role.id for role in to_add)
+            final[member.id] = frozenset(role_ids)
+        return final
+
+    def __len__(self):
+        return len(self._changes)
+
+    def __iter__(self):
+        return iter(self._changes.values())
+
+
+class RoleApplier:
+    """Applies accumulated `RoleChanges` with one edit per member.
+
+    Edits run concurrently on a small pool of workers and are paced by a
+    token bucket so a large backfill stays inside Discord's rate limits.
+    Bulk edits use the bucket's background lane and yield to the role
+    changes made for commands through `add_roles` and `remove_roles`. In
+    dry-run mode bulk edits are only logged.
+    """
+
+    def __init__(
+        self, concurrency=EDIT_CONCURRENCY, rate=EDIT_RATE, per=EDIT_PER, dry_run=False
+    ):
+        self.concurrency = concurrency
+        self.dry_run = dry_run
+        self.limiter = PriorityRateLimiter(rate, per)
+        self._own_edits = {}
+
+    def _expire_edits(self):
+        now = time.monotonic()
+        self._own_edits = {
+            key: value for key, value in self._own_edits.items() if value[1] > now
+        }
+
+    def _remember_edit(self, member, roles):
+        self._own_edits[(member.guild.id, member.id)] = (
+            frozenset(role.id for role in roles),
+            time.monotonic() + OWN_EDIT_TTL,
+        )
+
+    def _forget_edit(self, member):
+        self._own_edits.pop((member.guild.id, member.id), None)
+
+    def is_own_edit(self, member):
+        """Whether the member's current roles are the result of our last edit."""
+        key = (member.guild.id, member.id)
+        own_edit = self._own_edits.get(key)
+        if own_edit is None:
+            return False
+
+        role_ids, expires = own_edit
+        if expires < time.monotonic():
+            del self._own_edits[key]
+            return False
+
+        current = frozenset(role.id for role in member.roles if not role.is_default())
+        if current != role_ids:
+            return False
+
+        del self._own_edits[key]
+        return True
+
+    @staticmethod
+    def get_final_roles(member, to_add, to_remove):
+        current = {role for role in member.roles if not role.is_default()}
+        final = current.difference(to_remove).union(to_add)
+        if final == current:
+            return None
+        return final
+
+    async def _mutate_roles(self, mutate, roles, source, action, reason):
+        for role in roles:
+            await self.limiter.acquire(LANE_INTERACTIVE)
+            ROLE_MUTATIONS.inc(source=source, action=action)
+            try:
+                await mutate(role, reason=reason)
+            except discord.HTTPException:
+                ROLE_MUTATION_FAILURES.inc(source=source)
+                raise
+
+    async def add_roles(self, member, source, *roles, reason=None):
+        """Add roles to a member ahead of any bulk edits.
+
+        Each role is added on its own rather than by replacing the member's
+        role list, so concurrent changes to their other roles are kept.
+        """
+        roles = [role for role in roles if member.get_role(role.id) is None]
+        await self._mutate_roles(member.add_roles, roles, source, "add", reason)
+
+    async def remove_roles(self, member, source, *roles, reason=None):
+        """Remove roles from a member ahead of any bulk edits."""
+        roles = [role for role in roles if member.get_role(role.id) is not None]
+        await self._mutate_roles(member.remove_roles, roles, source, "remove", reason)
+
+    async def apply(self, changes, source, reason=None):
+        total = len(changes)
+        if not total:
+            return 0
+
+        if self.dry_run:
+            for member, to_add, to_remove in changes:
+                logging.info(
+                    "Dry run: would add %s and remove %s for user %s (%s)",
+                    ", ".join(role.name for role in to_add) or "nothing",
+                    ", ".join(role.name for role in to_remove) or "nothing",
+                    member.name,
+                    source,
+                )
+            return 0
+
+        self._expire_edits()
+        pending = iter(changes)
+        applied = 0
+        failed = 0
+        started = time.monotonic()
+        last_report = started
+
+        async def worker():
+            nonlocal applied, failed, last_report
+
+            for member, to_add, to_remove in pending:
+                if self.get_final_roles(member, to_add, to_remove) is None:
+                    continue
+
+                await self.limiter.acquire(LANE_BACKGROUND)
+                # The role list replaces the member's roles as a whole, so it
+                # is only built once the edit is about to be sent. Waiting for
+                # the rate limiter can take a while and commands may have
+                # changed the member's roles in the meantime.
+                final_roles = self.get_final_roles(member, to_add, to_remove)
+                if final_roles is None:
+                    continue
+                # Remembered before the request as the resulting member update
+                # can arrive over the gateway before the request returns.
+                self._remember_edit(member, final_roles)
+                ROLE_MUTATIONS.inc(source=source, action="edit")
+                try:
+                    await member.edit(roles=list(final_roles), reason=reason)
+                except discord.HTTPException:
+                    logging.exception("Failed to edit roles for user %s", member.name)
+                    ROLE_MUTATION_FAILURES.inc(source=source)
+                    self._forget_edit(member)
+                    failed += 1
+                    continue
+
+                applied += 1
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    logging.info(
+                        "Applied %s/%s role edits (%.1f/s)",
+                        applied,
+                        total,
+                        applied / (now - started),
+                    )
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+        elapsed = time.monotonic() - started
+        logging.info(
+            "Applied %s role edits for %s members in %.1fs (%.1f/s, %s failed)",
+            applied,
+            total,
+            elapsed,
+            applied / elapsed if elapsed else 0.0,
+            failed,
+        )
+        return applied
+
+    async def apply_all(self, changes_by_guild, source, reason=None):
+        """Apply every guild's `RoleChanges` from a sync.
+
+        Guilds apply concurrently and share the rate limit.
+        """
+        with SYNC_PHASE_DURATION.time(sync=source, phase="apply"):
+            await asyncio.gather(
+                *(
+                    self.apply(changes, source=source, reason=reason)
+                    for changes in changes_by_guild.values()
+                )
+            )
@@ -0,0 +1,69 @@
+class RoleMemberIndex:
+    """Reverse index from role IDs to the IDs of the members holding them.
+
+    Only roles that have been explicitly tracked are indexed. A tracked
+    role is built once from the guild's member cache and then kept up to
+    date from member and role gateway events so that sync tasks can find
+    the holders of a role without scanning every member of the guild.
+    """
+
+    def __init__(self):
+        self._members_by_role = {}
+
+    def clear(self):
+        self._members_by_role.clear()
+
+    def track(self, guild, roles):
+        untracked = {role.id for role in roles if role.id not in self._members_by_role}
+        if not untracked:
+            return
+
+        for role_id in untracked:
+            self._members_by_role[role_id] = set()
+
+        for member in guild.members:
+            for role in member.roles:
+                if role.id in untracked:
+                    self._members_by_role[role.id].add(member.id)
+
+    def members_with(self, roles):
+        member_ids = set()
+        for role in roles:
+            member_ids.update(self._members_by_role.get(role.id, ()))
+        return member_ids
+
+    def roles_by_member(self, roles):
+        """Map each member holding any of `roles` to the IDs of those they hold."""
+        held = {}
+        for role in roles:
+            for member_id in self._members_by_role.get(role.id, ()):
+                held.setdefault(member_id, set()).add(role.id)
+        return {member_id: frozenset(role_ids) for member_id, role_ids in held.items()}
+
+    def add_member(self, member):
+        for role in member.roles:
+            member_ids = self._members_by_role.get(role.id)
+            if member_ids is not None:
+                member_ids.add(member.id)
+
+    def remove_member(self, member):
+        for role in member.roles:
+            member_ids = self._members_by_role.get(role.id)
+            if member_ids is not None:
+                member_ids.discard(member.id)
+
+    def update_member(self, before, after):
+        before_ids = {role.id for role in before.roles}
+        after_ids = {role.id for role in after.roles}
+
+        for role_id in before_ids.symmetric_difference(after_ids):
+            member_ids = self._members_by_role.get(role_id)
+            if member_ids is None:
+                continue
+            if role_id in after_ids:
+                member_ids.add(after.id)
+            else:
+                member_ids.discard(after.id)
+
+    def remove_role(self, role):
+        self._members_by_role.pop(role.id, None)
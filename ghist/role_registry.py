@@ -0,0 +1,70 @@
+class RoleRegistry:
+    """Per-guild maps of roles whose names start with a registered prefix.
+
+    Each registered prefix gets a map of key to role for every guild. By
+    default the key is the role name without the prefix, lowercased, which
+    is what users type in commands; prefixes registered with `strip=False`
+    are keyed by the full role name instead.
+
+    Maps are built once per guild and then updated incrementally from role
+    gateway events. The returned maps are shared and must not be modified.
+    """
+
+    def __init__(self):
+        self._prefixes = {}
+        self._guilds = {}
+
+    def register(self, prefix, strip=True):
+        if self._prefixes.get(prefix) == strip:
+            return
+        self._prefixes[prefix] = strip
+        # Existing guild maps don't know about the new prefix.
+        self._guilds.clear()
+
+    def _get_key(self, prefix, name):
+        if self._prefixes[prefix]:
+            return name[len(prefix) :].lower()
+        return name
+
+    def clear(self):
+        self._guilds.clear()
+
+    def build(self, guild):
+        maps = {prefix: {} for prefix in self._prefixes}
+        for role in guild.roles:
+            for prefix, roles in maps.items():
+                if role.name.startswith(prefix):
+                    roles[self._get_key(prefix, role.name)] = role
+        self._guilds[guild.id] = maps
+        return maps
+
+    def remove_guild(self, guild):
+        self._guilds.pop(guild.id, None)
+
+    def get(self, guild, prefix):
+        maps = self._guilds.get(guild.id)
+        if maps is None:
+            maps = self.build(guild)
+        return maps[prefix]
+
+    def add_role(self, role):
+        maps = self._guilds.get(role.guild.id)
+        if maps is None:
+            return
+        for prefix, roles in maps.items():
+            if role.name.startswith(prefix):
+                roles[self._get_key(prefix, role.name)] = role
+
+    def remove_role(self, role):
+        maps = self._guilds.get(role.guild.id)
+        if maps is None:
+            return
+        for prefix, roles in maps.items():
+            if role.name.startswith(prefix):
+                key = self._get_key(prefix, role.name)
+                if key in roles and roles[key].id == role.id:
+                    del roles[key]
+
+    def update_role(self, before, after):
+        self.remove_role(before)
+        self.add_role(after)
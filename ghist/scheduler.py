@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+
+from ghist.metrics import sync_run
+from ghist.profiling import cog_context, get_owner_name
+
+# Seconds past midnight a daily job fires at, so a slightly early wakeup
+# still lands on the new day.
+MIDNIGHT_MARGIN = 1.0
+# How soon a daily job that didn't complete is tried again.
+DAILY_RETRY_DELAY = 60.0
+
+
+class IntervalTrigger:
+    """Fires every `seconds`, give or take `jitter` as a fraction of the interval.
+
+    When a run reports that it found nothing to change the interval is
+    multiplied by `backoff`, up to `max_seconds`, and it drops back to
+    `seconds` as soon as a run changes something again.
+    """
+
+    def __init__(self, seconds, jitter=0.0, backoff=1.0, max_seconds=None):
+        self.seconds = seconds
+        self.jitter = jitter
+        self.backoff = backoff
+        self.max_seconds = max_seconds or seconds
+        self.interval = seconds
+
+    def next_delay(self, changed):
+        if changed is False:
+            self.interval = min(self.interval * self.backoff, self.max_seconds)
+        else:
+            self.interval = self.seconds
+
+        if not self.jitter:
+            return self.interval
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class DailyTrigger:
+    """Fires shortly after every UTC midnight.
+
+    A run that returns None, as failed runs do, is retried after
+    `retry_delay` seconds instead of waiting for the next midnight.
+    """
+
+    interval = 24 * 60 * 60
+
+    def __init__(self, retry_delay=DAILY_RETRY_DELAY):
+        self.retry_delay = retry_delay
+
+    def next_delay(self, changed):
+        if changed is None:
+            return self.retry_delay
+
+        now = datetime.utcnow()
+        midnight = datetime(now.year, now.month, now.day) + timedelta(days=1)
+        return (midnight - now).total_seconds() + MIDNIGHT_MARGIN
+
+
+class Job:
+    """A coroutine function run repeatedly according to a trigger.
+
+    The callback may return False to report that it had nothing to do,
+    which lets interval triggers back off, while None means the run didn't
+    complete. Runs never overlap: a run asked for while one is in progress
+    starts once it finishes.
+    """
+
+    def __init__(self, name, callback, trigger, wait_until_ready, run_at_start=True):
+        self.name = name
+        self.callback = callback
+        self.trigger = trigger
+        self.wait_until_ready = wait_until_ready
+        self.run_at_start = run_at_start
+        self.lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run_forever())
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def run_now(self):
+        """Run the job as soon as possible instead of waiting for its trigger."""
+        self._wakeup.set()
+
+    async def run(self):
+        cog = get_owner_name(self.callback) or "bot"
+        async with self.lock:
+            with cog_context(cog), sync_run(self.name, self.trigger.interval):
+                try:
+                    return await self.callback()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logging.exception("Scheduled job %s failed", self.name)
+
+    async def _run_forever(self):
+        logging.info("Waiting for bot to be ready before starting %s...", self.name)
+        await self.wait_until_ready()
+
+        # Asked as if after a successful run, as None would mean a retry.
+        delay = 0 if self.run_at_start else self.trigger.next_delay(True)
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            changed = await self.run()
+            delay = self.trigger.next_delay(changed)
+            logging.debug("Next run of %s in %.0f seconds", self.name, delay)
+
+
+class Scheduler:
+    """Runs the bot's periodic jobs once the bot is ready."""
+
+    def __init__(self, wait_until_ready):
+        self.wait_until_ready = wait_until_ready
+        self.jobs = {}
+
+    def add_job(self, name, callback, trigger, run_at_start=True):
+        if name in self.jobs:
+            raise ValueError(f"Job {name} is already scheduled")
+
+        job = Job(name, callback, trigger, self.wait_until_ready, run_at_start)
+        self.jobs[name] = job
+        job.start()
+        return job
+
+    def remove_job(self, name):
+        job = self.jobs.pop(name, None)
+        if job is not None:
+            job.cancel()
+
+    def run_now(self, name):
+        self.jobs[name].run_now()
+
+    def close(self):
+        for job in self.jobs.values():
+            job.cancel()
+        self.jobs.clear()
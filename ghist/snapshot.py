@@ -0,0 +1,269 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of payload versions kept per scope.
+KEEP_VERSIONS = 3
+# Snapshots older than this aren't used as a fallback for missing api data.
+MAX_FALLBACK_AGE = 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payloads (
+    scope TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (scope, fetched_at)
+);
+CREATE TABLE IF NOT EXISTS applied_roles (
+    scope TEXT NOT NULL,
+    guild_id INTEGER NOT NULL,
+    member_id INTEGER NOT NULL,
+    role_ids TEXT NOT NULL,
+    PRIMARY KEY (scope, guild_id, member_id)
+);
+"""
+
+EMPTY_ROLES = frozenset()
+
+
+def get_fingerprint(*parts):
+    """Digest of JSON serializable `parts`, see `SyncState.fingerprint`."""
+    data = json.dumps(parts, sort_keys=True).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class SyncState:
+    """The last payload a sync reconciled and the roles it left members with.
+
+    `payload` maps member IDs to whatever per-member entry the sync derives
+    its roles from and `applied` maps member IDs to the IDs of the managed
+    roles the sync last set for them. Comparing these against fresh data
+    and the roles members currently hold tells a sync which members can
+    possibly need changes.
+
+    Plans also depend on inputs that aren't per member, such as which
+    managed roles exist in the guild. `fingerprint` identifies those and
+    every member is planned again whenever it changes.
+    """
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.payload = {}
+        self.fetched_at = None
+        self.applied = {}
+        self.fingerprint = None
+        self.loaded = False
+
+    def is_fresh(self):
+        return (
+            self.fetched_at is not None
+            and time.time() - self.fetched_at <= MAX_FALLBACK_AGE
+        )
+
+    def get_members_to_plan(self, payload, held_roles, fingerprint, incremental):
+        """Members who can need changes given a fresh payload and roles.
+
+        Incremental syncs only look at members whose managed roles changed,
+        as `payload` is the one that was already reconciled. The sync sets
+        `fingerprint` once the members have been planned.
+        """
+        if fingerprint != self.fingerprint:
+            return set(
+                self.payload.keys()
+                | payload.keys()
+                | self.applied.keys()
+                | held_roles.keys()
+            )
+        if incremental:
+            return self.get_changed_members(held_roles)
+        return self.get_dirty_members(payload, held_roles)
+
+    def get_dirty_members(self, payload, held_roles):
+        dirty = {
+            member_id
+            for member_id in self.payload.keys() | payload.keys()
+            if self.payload.get(member_id) != payload.get(member_id)
+        }
+        dirty.update(self.get_changed_members(held_roles))
+        return dirty
+
+    def get_changed_members(self, held_roles):
+        """Members whose managed roles differ from the ones last applied."""
+        return {
+            member_id
+            for member_id in self.applied.keys() | held_roles.keys()
+            if self.applied.get(member_id, EMPTY_ROLES)
+            != held_roles.get(member_id, EMPTY_ROLES)
+        }
+
+    def store_payload(self, payload, absent_ids, fetched_at, member_ids=None):
+        """Store the payload a sync reconciled, fetched at `fetched_at`.
+
+        Only the entries of `member_ids` are replaced if given. Members who
+        aren't in the guild are left out so they are looked at again on the
+        next sync in case they join.
+        """
+        if member_ids is None:
+            self.payload = {
+                member_id: entry
+                for member_id, entry in payload.items()
+                if member_id not in absent_ids
+            }
+        else:
+            for member_id in member_ids:
+                entry = payload.get(member_id)
+                if entry is None or member_id in absent_ids:
+                    self.payload.pop(member_id, None)
+                else:
+                    self.payload[member_id] = entry
+        self.fetched_at = fetched_at
+
+    def set_applied(self, member_id, role_ids):
+        if role_ids:
+            self.applied[member_id] = frozenset(role_ids)
+        else:
+            self.applied.pop(member_id, None)
+
+
+class Snapshot:
+    """SQLite-backed store of `SyncState`s so syncs can resume after a restart.
+
+    All database access happens on a single worker thread to keep it off the
+    event loop and to keep the connection confined to one thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="snapshot"
+        )
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _load(self, scope, guild_id):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT fetched_at, body FROM payloads WHERE scope = ? "
+            "ORDER BY fetched_at DESC LIMIT 1",
+            (scope,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        applied = {}
+        for member_id, role_ids in conn.execute(
+            "SELECT member_id, role_ids FROM applied_roles "
+            "WHERE scope = ? AND guild_id = ?",
+            (scope, guild_id),
+        ):
+            applied[member_id] = frozenset(
+                int(role_id) for role_id in role_ids.split(",") if role_id
+            )
+
+        stored = json.loads(row[1])
+        # Snapshots from before fingerprints were stored hold the body alone.
+        if not isinstance(stored, dict) or stored.keys() != {"fingerprint", "body"}:
+            stored = {"fingerprint": None, "body": stored}
+        return row[0], stored["fingerprint"], stored["body"], applied
+
+    def _save(self, scope, guild_id, fetched_at, fingerprint, body, applied):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO payloads (scope, fetched_at, body) "
+                "VALUES (?, ?, ?)",
+                (
+                    scope,
+                    fetched_at,
+                    json.dumps({"fingerprint": fingerprint, "body": body}),
+                ),
+            )
+            conn.execute(
+                "DELETE FROM payloads WHERE scope = ? AND fetched_at NOT IN ("
+                "SELECT fetched_at FROM payloads WHERE scope = ? "
+                "ORDER BY fetched_at DESC LIMIT ?)",
+                (scope, scope, KEEP_VERSIONS),
+            )
+            conn.execute(
+                "DELETE FROM applied_roles WHERE scope = ? AND guild_id = ?",
+                (scope, guild_id),
+            )
+            conn.executemany(
+                "INSERT INTO applied_roles (scope, guild_id, member_id, role_ids) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    (scope, guild_id, member_id, ",".join(map(str, role_ids)))
+                    for member_id, role_ids in applied.items()
+                ),
+            )
+
+    async def load(self, state, guild_id, decode):
+        """Restore `state` from the latest snapshot for its scope.
+
+        `decode` turns the stored payload body back into the state's payload
+        mapping and may return None if the stored body is no longer usable.
+        """
+        state.loaded = True
+        try:
+            row = await self._run(self._load, state.scope, guild_id)
+        except sqlite3.Error:
+            logging.exception("Failed to load snapshot for %s", state.scope)
+            return
+
+        if row is None:
+            return
+
+        fetched_at, fingerprint, body, applied = row
+        payload = decode(body)
+        if payload is None:
+            logging.warning("Discarding incompatible snapshot for %s", state.scope)
+            return
+
+        state.payload = payload
+        state.fetched_at = fetched_at
+        state.applied = applied
+        state.fingerprint = fingerprint
+        logging.info(
+            "Loaded snapshot for %s with %s entries from %s",
+            state.scope,
+            len(payload),
+            time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(fetched_at)),
+        )
+
+    async def save(self, state, guild_id, body):
+        """Store `state` along with its payload encoded as `body`."""
+        try:
+            await self._run(
+                self._save,
+                state.scope,
+                guild_id,
+                state.fetched_at,
+                state.fingerprint,
+                body,
+                dict(state.applied),
+            )
+        except sqlite3.Error:
+            logging.exception("Failed to save snapshot for %s", state.scope)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        # Runs after any pending writes as the executor has a single worker.
+        await self._run(self._close)
+        self._executor.shutdown(wait=False)
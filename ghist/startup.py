@@ -0,0 +1,32 @@
+import logging
+import time
+
+from ghist.metrics import STARTUP_PHASE_DURATION
+
+
+class StartupTimer:
+    """Times the phases of bot startup, each measured from the end of the last."""
+
+    def __init__(self, started_at=None):
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self._last = self.started_at
+        self.durations = {}
+
+    def mark(self, phase):
+        """End `phase` now. Returns False if it was already marked."""
+        if phase in self.durations:
+            return False
+
+        now = time.perf_counter()
+        self.durations[phase] = now - self._last
+        self._last = now
+        STARTUP_PHASE_DURATION.set(self.durations[phase], phase=phase)
+        return True
+
+    def report(self):
+        phases = ", ".join(
+            f"{phase} {duration:.2f}s" for phase, duration in self.durations.items()
+        )
+        logging.info(
+            "Startup took %.2fs (%s)", self._last - self.started_at, phases
+        )
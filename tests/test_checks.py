@@ -0,0 +1,32 @@
+from ghist.checks import NO_CHANNELS, ChannelPolicy
+
+
+def test_from_config_converts_ids():
+    policy = ChannelPolicy.from_config(
+        {
+            "support-channels": {"100": ["1", 2], "200": []},
+            "dogs-channels": ["3"],
+            "daily-channels": [4, "5"],
+            "command-channels": {"color": ["6"]},
+        }
+    )
+
+    assert policy.support_channels == {100: {1, 2}, 200: set()}
+    assert policy.dogs_channels == {3}
+    assert policy.daily_channels == {4, 5}
+    assert policy.command_channels == {"color": {6}}
+    assert isinstance(policy.daily_channels, frozenset)
+
+
+def test_from_config_defaults():
+    policy = ChannelPolicy.from_config({})
+
+    assert policy == ChannelPolicy()
+    assert policy.get_support_channels(100) == NO_CHANNELS
+
+
+def test_support_channels_by_guild():
+    policy = ChannelPolicy.from_config({"support-channels": {"100": ["1"]}})
+
+    assert policy.get_support_channels(100) == {1}
+    assert policy.get_support_channels(200) == NO_CHANNELS
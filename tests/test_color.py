@@ -0,0 +1,78 @@
+import io
+
+import pytest
+from PIL import Image
+
+from bench.palette_bench import count_wrong_swatches, make_colors
+from ghist.cogs.color import (
+    PNG_FORMAT,
+    draw_available_colors,
+    encode_image,
+    get_layout,
+    get_palette,
+)
+
+
+def draw(colors):
+    size, swatches = get_layout(colors)
+    return draw_available_colors(size, swatches), swatches
+
+
+def encode_rgba_png(img):
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf
+
+
+@pytest.mark.parametrize("num_colors", [1, 10, 126, 127, 200, 253])
+def test_png_keeps_swatch_colors(num_colors):
+    colors = make_colors(num_colors)
+    img, swatches = draw(colors)
+
+    buf, image_format = encode_image(img, swatches, PNG_FORMAT)
+
+    assert image_format == PNG_FORMAT
+    assert count_wrong_swatches(img, colors, buf) == 0
+
+
+def test_png_keeps_close_swatch_colors():
+    colors = {f"Color: Red {idx}": (200 + idx, idx % 3, 0) for idx in range(40)}
+    img, swatches = draw(colors)
+
+    buf, _ = encode_image(img, swatches, PNG_FORMAT)
+
+    assert count_wrong_swatches(img, colors, buf) == 0
+
+
+@pytest.mark.parametrize("num_colors", [10, 127, 200])
+def test_png_is_a_quarter_of_rgba(num_colors):
+    img, swatches = draw(make_colors(num_colors))
+
+    buf, _ = encode_image(img, swatches, PNG_FORMAT)
+
+    assert len(buf.getvalue()) * 4 < len(encode_rgba_png(img).getvalue())
+
+
+def test_png_keeps_transparent_cells():
+    # Five colors leave the last column a cell short.
+    img, swatches = draw(make_colors(5))
+
+    buf, _ = encode_image(img, swatches, PNG_FORMAT)
+    decoded = Image.open(buf).convert("RGBA")
+
+    corner = (img.width - 1, img.height - 1)
+    assert img.getpixel(corner)[3] == 0
+    assert decoded.getpixel(corner)[3] == 0
+
+
+def test_palette_holds_every_swatch():
+    _, swatches = get_layout(make_colors(253))
+    palette = get_palette(swatches)
+
+    assert len(palette) == 255
+    assert {rgb for _, _, rgb in swatches} <= set(palette)
+
+
+def test_palette_falls_back_when_full():
+    _, swatches = get_layout(make_colors(254))
+    assert get_palette(swatches) is None
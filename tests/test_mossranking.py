@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import pytest
+
+from ghist.mossranking import MossrankingError, iter_json_array
+
+ELEMENTS = [
+    {"discord_id": "1", "games": 3, "title": "Grand Champion"},
+    {"discord_id": "2", "games": 0, "title": "Café ☕ runner"},
+    12345,
+    "a, string ] with [ brackets",
+    [1, [2, 3]],
+    True,
+    None,
+]
+
+
+async def iter_chunks(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def decode(chunks):
+    async def collect():
+        return [element async for element in iter_json_array(iter_chunks(chunks))]
+
+    return asyncio.run(collect())
+
+
+def test_decodes_whole_document():
+    assert decode([json.dumps(ELEMENTS).encode()]) == ELEMENTS
+
+
+def test_decodes_elements_split_at_every_byte():
+    data = json.dumps(ELEMENTS, ensure_ascii=False, indent=1).encode()
+    for split in range(1, len(data)):
+        assert decode([data[:split], data[split:]]) == ELEMENTS
+
+
+def test_decodes_single_byte_chunks():
+    data = json.dumps(ELEMENTS, ensure_ascii=False).encode()
+    assert decode([data[idx : idx + 1] for idx in range(len(data))]) == ELEMENTS
+
+
+@pytest.mark.parametrize(
+    "chunks, expected",
+    [
+        ([b"[12", b"34]"], [1234]),
+        ([b"[12.", b"5]"], [12.5]),
+        ([b"[1e", b"3]"], [1000.0]),
+        ([b"[1.5E", b"-2, 2]"], [0.015, 2]),
+        ([b"[-", b"7]"], [-7]),
+        ([b"[tr", b"ue, nu", b"ll]"], [True, None]),
+    ],
+)
+def test_decodes_scalars_split_across_chunks(chunks, expected):
+    assert decode(chunks) == expected
+
+
+def test_empty_array():
+    assert decode([b" [ ", b"] "]) == []
+
+
+def test_rejects_non_array():
+    with pytest.raises(MossrankingError):
+        decode([b'{"a": 1}'])
+
+
+def test_rejects_truncated_array():
+    with pytest.raises(MossrankingError):
+        decode([b'[{"a": 1}, {"b"'])
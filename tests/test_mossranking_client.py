@@ -0,0 +1,142 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+
+from ghist.mossranking import (
+    MR_RANKING_ENDPOINT,
+    MossrankingClient,
+    NotModified,
+    Validators,
+)
+
+ETAG = '"v1"'
+LAST_MODIFIED = "Wed, 14 Oct 2026 12:00:00 GMT"
+
+
+class RankingServer:
+    """Serves one ranking payload and records the headers of each request."""
+
+    def __init__(self, payload, headers=None, honor_conditionals=True):
+        self.payload = payload
+        self.headers = headers or {}
+        self.honor_conditionals = honor_conditionals
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append(request.headers)
+        if self.honor_conditionals:
+            etag = self.headers.get("ETag")
+            if etag and request.headers.get("If-None-Match") == etag:
+                return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(
+            body=json.dumps(self.payload).encode(),
+            content_type="application/json",
+            headers=self.headers,
+        )
+
+
+def run_with_client(server, func):
+    async def run():
+        app = web.Application()
+        app.router.add_get("/" + MR_RANKING_ENDPOINT, server.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        client = MossrankingClient("key", f"http://127.0.0.1:{port}/")
+        try:
+            return await func(client)
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_returns_payload_and_updates_validators():
+    server = RankingServer(
+        {"1": "Cosmos Explorer"},
+        headers={"ETag": ETAG, "Last-Modified": LAST_MODIFIED},
+    )
+    validators = Validators()
+
+    async def fetch(client):
+        return await client.get_discord_user_ranking(2, validators=validators)
+
+    assert run_with_client(server, fetch) == {"1": "Cosmos Explorer"}
+    assert validators.etag == ETAG
+    assert validators.last_modified == LAST_MODIFIED
+    assert validators.digest is not None
+    assert "If-None-Match" not in server.requests[0]
+    assert "If-Modified-Since" not in server.requests[0]
+
+
+def test_sends_validators_back_and_raises_not_modified_on_304():
+    server = RankingServer(
+        {"1": "Cosmos Explorer"},
+        headers={"ETag": ETAG, "Last-Modified": LAST_MODIFIED},
+    )
+    validators = Validators()
+
+    async def fetch_twice(client):
+        await client.get_discord_user_ranking(2, validators=validators)
+        with pytest.raises(NotModified):
+            await client.get_discord_user_ranking(2, validators=validators)
+
+    run_with_client(server, fetch_twice)
+    assert server.requests[1]["If-None-Match"] == ETAG
+    assert server.requests[1]["If-Modified-Since"] == LAST_MODIFIED
+
+
+def test_identical_body_raises_not_modified_without_server_validators():
+    server = RankingServer({"1": "Cosmos Explorer"})
+    validators = Validators()
+
+    async def fetch(client):
+        await client.get_discord_user_ranking(2, validators=validators)
+        digest = validators.digest
+        with pytest.raises(NotModified):
+            await client.get_discord_user_ranking(2, validators=validators)
+        assert validators.digest == digest
+
+        server.payload = {"1": "Sunken City Explorer"}
+        assert await client.get_discord_user_ranking(2, validators=validators) == {
+            "1": "Sunken City Explorer"
+        }
+        assert validators.digest != digest
+
+    run_with_client(server, fetch)
+    assert all("If-None-Match" not in headers for headers in server.requests)
+
+
+def test_identical_body_raises_not_modified_when_server_ignores_validators():
+    server = RankingServer(
+        {"1": "Cosmos Explorer"}, headers={"ETag": ETAG}, honor_conditionals=False
+    )
+    validators = Validators()
+
+    async def fetch(client):
+        await client.get_discord_user_ranking(2, validators=validators)
+        with pytest.raises(NotModified):
+            await client.get_discord_user_ranking(2, validators=validators)
+
+    run_with_client(server, fetch)
+    assert server.requests[1]["If-None-Match"] == ETAG
+
+
+def test_fetches_unconditionally_without_validators():
+    server = RankingServer({"1": "Cosmos Explorer"}, headers={"ETag": ETAG})
+
+    async def fetch_twice(client):
+        first = await client.get_discord_user_ranking(2)
+        second = await client.get_discord_user_ranking(2)
+        return first, second
+
+    assert run_with_client(server, fetch_twice) == (
+        {"1": "Cosmos Explorer"},
+        {"1": "Cosmos Explorer"},
+    )
+    assert all("If-None-Match" not in headers for headers in server.requests)
@@ -0,0 +1,147 @@
+import asyncio
+
+from ghist.cogs.sync_ranking_icons import Ranking
+from ghist.planner import (
+    SKIP_MISSING_ROLE,
+    SKIP_UNMATCHED_TITLE,
+    PlanRecorder,
+    get_pending_changes,
+    load_recording,
+    plan_badge_member,
+    plan_members,
+    plan_mossranking_member,
+)
+
+MEMBER_ID = 1
+MR_ROLE = 10
+GAME_ROLE_BITS = {11: 0b01, 12: 0b10}
+SYNC_ROLE = 20
+RANKING_ROLE_IDS = {"Badge: Gold": 21, "Badge: Silver": 22}
+OTHER_ROLE = 99
+
+
+def match_title(title):
+    return {
+        "Gold runner": Ranking(contains="Gold", role="Badge: Gold"),
+        "Silver runner": Ranking(contains="Silver", role="Badge: Silver"),
+        "Retired runner": Ranking(contains="Retired", role="Badge: Retired"),
+    }.get(title)
+
+
+def plan_mr(held, games):
+    return plan_mossranking_member(
+        MEMBER_ID, frozenset(held), games, MR_ROLE, GAME_ROLE_BITS
+    )
+
+
+def plan_badge(held, title):
+    return plan_badge_member(
+        MEMBER_ID, frozenset(held), title, SYNC_ROLE, RANKING_ROLE_IDS, match_title
+    )
+
+
+def test_mossranking_linked_member_gets_role_and_games():
+    plan = plan_mr({OTHER_ROLE}, 0b10)
+    assert plan.desired == {MR_ROLE, 12}
+    assert plan.add == {MR_ROLE, 12}
+    assert plan.remove == set()
+
+
+def test_mossranking_swaps_game_roles():
+    plan = plan_mr({MR_ROLE, 11}, 0b10)
+    assert plan.add == {12}
+    assert plan.remove == {11}
+
+
+def test_mossranking_unlinked_member_loses_managed_roles_only():
+    plan = plan_mr({MR_ROLE, 11, 12, OTHER_ROLE}, None)
+    assert plan.desired == set()
+    assert plan.add == set()
+    assert plan.remove == {MR_ROLE, 11, 12}
+
+
+def test_mossranking_up_to_date_member_is_unchanged():
+    plan = plan_mr({MR_ROLE, 11, 12}, 0b11)
+    assert not plan.add and not plan.remove
+
+
+def test_badge_member_gets_matching_badge():
+    plan = plan_badge({SYNC_ROLE}, "Gold runner")
+    assert plan.desired == {SYNC_ROLE, 21}
+    assert plan.add == {21}
+    assert plan.remove == set()
+    assert plan.skipped is None
+
+
+def test_badge_member_swaps_badges():
+    plan = plan_badge({SYNC_ROLE, 22}, "Gold runner")
+    assert plan.add == {21}
+    assert plan.remove == {22}
+
+
+def test_badge_member_without_sync_role_loses_badges():
+    plan = plan_badge({21, 22, OTHER_ROLE}, "Gold runner")
+    assert plan.desired == set()
+    assert plan.add == set()
+    assert plan.remove == {21, 22}
+
+
+def test_badge_member_without_title_keeps_sync_role_only():
+    plan = plan_badge({SYNC_ROLE, 21}, None)
+    assert plan.desired == {SYNC_ROLE}
+    assert plan.remove == {21}
+
+
+def test_badge_unmatched_title_leaves_badges_alone():
+    plan = plan_badge({SYNC_ROLE, 22}, "Unknown runner")
+    assert plan.skipped == SKIP_UNMATCHED_TITLE
+    assert not plan.add and not plan.remove
+
+
+def test_badge_missing_role_leaves_badges_alone():
+    plan = plan_badge({SYNC_ROLE, 22}, "Retired runner")
+    assert plan.skipped == SKIP_MISSING_ROLE
+    assert not plan.add and not plan.remove
+
+
+def test_plan_members_reports_absent_members():
+    member_roles = {1: frozenset({MR_ROLE}), 2: frozenset()}
+
+    plans, absent_ids = plan_members(
+        member_roles, [1, 2, 3], lambda member_id, held: plan_mr(held, 0b01)
+    )
+
+    assert [plan.add for plan in plans] == [{11}, {MR_ROLE, 11}]
+    assert absent_ids == {3}
+
+
+def test_pending_changes_touching_managed_roles():
+    managed = {21, 22}
+    held_roles = {1: frozenset({21}), 2: frozenset({21})}
+    pending = {
+        # Swaps a managed role.
+        1: frozenset({22, OTHER_ROLE}),
+        # Only touches an unmanaged role.
+        2: frozenset({21, OTHER_ROLE}),
+        # Gains a managed role without holding any yet.
+        3: frozenset({22}),
+        # Holds no managed roles before or after.
+        4: frozenset({OTHER_ROLE}),
+    }
+
+    assert get_pending_changes(pending, held_roles, managed) == {1, 3}
+
+
+def test_recordings_in_the_same_second_are_kept(tmp_path):
+    recorder = PlanRecorder(tmp_path)
+    plan = plan_mr({OTHER_ROLE}, 0b01)
+
+    async def record():
+        for _ in range(3):
+            await recorder.record("mr-sync", {"guild_id": 1}, [plan])
+
+    asyncio.run(record())
+
+    recordings = sorted(tmp_path.glob("mr-sync-*.json"))
+    assert len(recordings) == 3
+    assert load_recording(recordings[0])["plan"] == [plan.to_dict()]
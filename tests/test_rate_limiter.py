@@ -0,0 +1,87 @@
+import asyncio
+
+from ghist.role_applier import LANE_BACKGROUND, LANE_INTERACTIVE, PriorityRateLimiter
+
+# Fast enough for tests while still making every acquisition past the
+# initial burst wait for a token.
+RATE = 2
+PER = 0.05
+
+
+def test_burst_is_not_delayed():
+    async def run():
+        limiter = PriorityRateLimiter(RATE, PER)
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        for _ in range(RATE):
+            await limiter.acquire()
+        return loop.time() - start
+
+    assert asyncio.run(run()) < PER
+
+
+def test_interactive_waiters_go_first():
+    async def run():
+        limiter = PriorityRateLimiter(RATE, PER)
+        for _ in range(RATE):
+            await limiter.acquire()
+
+        order = []
+
+        async def acquire(name, lane):
+            await limiter.acquire(lane)
+            order.append(name)
+
+        background = [
+            asyncio.ensure_future(acquire(f"background-{idx}", LANE_BACKGROUND))
+            for idx in range(3)
+        ]
+        # Let the background waiters queue up before the interactive one.
+        await asyncio.sleep(0)
+        interactive = asyncio.ensure_future(acquire("interactive", LANE_INTERACTIVE))
+        await asyncio.gather(*background, interactive)
+        return order
+
+    assert asyncio.run(run()) == [
+        "interactive",
+        "background-0",
+        "background-1",
+        "background-2",
+    ]
+
+
+def test_new_acquisitions_queue_behind_waiters():
+    async def run():
+        limiter = PriorityRateLimiter(RATE, PER)
+        for _ in range(RATE):
+            await limiter.acquire()
+
+        order = []
+
+        async def acquire(name):
+            await limiter.acquire(LANE_BACKGROUND)
+            order.append(name)
+
+        first = asyncio.ensure_future(acquire("first"))
+        await asyncio.sleep(PER)
+        # A token is available again but the first waiter is owed it.
+        await acquire("second")
+        await first
+        return order
+
+    assert asyncio.run(run()) == ["first", "second"]
+
+
+def test_cancelled_waiters_are_skipped():
+    async def run():
+        limiter = PriorityRateLimiter(RATE, PER)
+        for _ in range(RATE):
+            await limiter.acquire()
+
+        cancelled = asyncio.ensure_future(limiter.acquire(LANE_INTERACTIVE))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.wait_for(limiter.acquire(LANE_BACKGROUND), timeout=1)
+        return cancelled.cancelled()
+
+    assert asyncio.run(run())
@@ -0,0 +1,83 @@
+import asyncio
+
+from bench.fakes import FakeBot, FakeGuild
+from ghist.cogs.sync_ranking_icons import MossRankingIconSync
+from ghist.role_applier import RoleApplier, RoleChanges
+
+GUILD_ID = 1 << 40
+MEMBER_ID = 1 << 41
+
+
+def make_guild(bot=None):
+    guild = FakeGuild(GUILD_ID)
+    if bot is not None:
+        bot.add_guild(guild)
+    badge = guild.add_role("Badge: 2 Cosmos")
+    sync_role = guild.add_role("Badge: MR-Sync 2")
+    member = guild.add_member(MEMBER_ID)
+    return guild, member, badge, sync_role
+
+
+async def apply(applier, member, *roles):
+    changes = RoleChanges()
+    changes.add(member, *roles)
+    return await applier.apply(changes, source="test")
+
+
+def test_own_edit_is_recognised_once():
+    async def run():
+        bot = FakeBot()
+        applier = bot.role_applier
+        _, member, badge, _ = make_guild(bot)
+        applied = await apply(applier, member, badge)
+        # The member update for an edit only arrives once.
+        return applied, applier.is_own_edit(member), applier.is_own_edit(member)
+
+    assert asyncio.run(run()) == (1, True, False)
+
+
+def test_later_changes_are_not_own_edits():
+    async def run():
+        bot = FakeBot()
+        applier = bot.role_applier
+        _, member, badge, sync_role = make_guild(bot)
+        await apply(applier, member, badge)
+        member._role_ids.add(sync_role.id)
+        return applier.is_own_edit(member)
+
+    assert not asyncio.run(run())
+
+
+def test_dry_runs_make_no_edits():
+    async def run():
+        applier = RoleApplier(dry_run=True)
+        _, member, badge, _ = make_guild()
+        applied = await apply(applier, member, badge)
+        return applied, member.get_role(badge.id), applier.is_own_edit(member)
+
+    assert asyncio.run(run()) == (0, None, False)
+
+
+def test_member_updates_from_own_edits_are_not_queued():
+    async def run():
+        bot = FakeBot()
+        _, member, badge, sync_role = make_guild(bot)
+        icon_sync = MossRankingIconSync(bot=bot, guild_ids=[GUILD_ID])
+        try:
+            changes = RoleChanges()
+            changes.add(member, sync_role, badge)
+            before = member._copy()
+            await bot.role_applier.apply(changes, source="test")
+            await icon_sync.on_member_update(before, member)
+            own_edit_queued = len(icon_sync.pending_members)
+
+            before = member._copy()
+            member._role_ids.discard(sync_role.id)
+            await icon_sync.on_member_update(before, member)
+            return own_edit_queued, len(icon_sync.pending_members)
+        finally:
+            icon_sync.cog_unload()
+
+    own_edit_queued, user_edit_queued = asyncio.run(run())
+    assert own_edit_queued == 0
+    assert user_edit_queued == 1
@@ -0,0 +1,76 @@
+from bench.fakes import FakeGuild
+from ghist.role_index import RoleMemberIndex
+
+
+def make_guild():
+    guild = FakeGuild(1)
+    tracked = guild.add_role("Tracked")
+    other = guild.add_role("Other")
+    guild.add_member(10, {tracked.id})
+    guild.add_member(11, {tracked.id, other.id})
+    guild.add_member(12, {other.id})
+    return guild, tracked, other
+
+
+def test_track_builds_from_member_cache():
+    guild, tracked, other = make_guild()
+    index = RoleMemberIndex()
+
+    index.track(guild, [tracked])
+
+    assert index.members_with([tracked]) == {10, 11}
+    # Untracked roles aren't indexed.
+    assert index.members_with([other]) == set()
+    assert index.roles_by_member([tracked, other]) == {
+        10: {tracked.id},
+        11: {tracked.id},
+    }
+
+
+def test_member_updates_keep_index_current():
+    guild, tracked, other = make_guild()
+    index = RoleMemberIndex()
+    index.track(guild, [tracked, other])
+
+    member = guild.get_member(12)
+    before = member._copy()
+    member._role_ids = {tracked.id}
+    index.update_member(before, member)
+
+    assert index.members_with([tracked]) == {10, 11, 12}
+    assert index.members_with([other]) == {11}
+
+
+def test_members_joining_and_leaving():
+    guild, tracked, _ = make_guild()
+    index = RoleMemberIndex()
+    index.track(guild, [tracked])
+
+    index.remove_member(guild.get_member(10))
+    index.add_member(guild.add_member(13, {tracked.id}))
+
+    assert index.members_with([tracked]) == {11, 13}
+
+
+def test_tracking_again_keeps_updates():
+    guild, tracked, _ = make_guild()
+    index = RoleMemberIndex()
+    index.track(guild, [tracked])
+    index.remove_member(guild.get_member(10))
+
+    # Already tracked roles aren't rebuilt from the member cache.
+    index.track(guild, [tracked])
+
+    assert index.members_with([tracked]) == {11}
+
+
+def test_deleted_roles_are_rebuilt_when_tracked():
+    guild, tracked, _ = make_guild()
+    index = RoleMemberIndex()
+    index.track(guild, [tracked])
+    index.remove_member(guild.get_member(10))
+
+    index.remove_role(tracked)
+    assert index.members_with([tracked]) == set()
+    index.track(guild, [tracked])
+    assert index.members_with([tracked]) == {10, 11}
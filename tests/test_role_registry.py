@@ -0,0 +1,98 @@
+from bench.fakes import FakeGuild, FakeRole
+from ghist.role_registry import RoleRegistry
+
+
+def make_registry():
+    registry = RoleRegistry()
+    registry.register("Color: ")
+    registry.register("Badge: ", strip=False)
+    registry.register("Badge: MR-Sync ", strip=False)
+    guild = FakeGuild(1)
+    return registry, guild
+
+
+def renamed(role, name):
+    return FakeRole(role.id, name, role.guild)
+
+
+def test_keys_by_prefix():
+    registry, guild = make_registry()
+    red = guild.add_role("Color: Red")
+    badge = guild.add_role("Badge: 2 Cosmos")
+    sync_role = guild.add_role("Badge: MR-Sync 2")
+    guild.add_role("Moderator")
+
+    assert registry.get(guild, "Color: ") == {"red": red}
+    assert registry.get(guild, "Badge: ") == {
+        "Badge: 2 Cosmos": badge,
+        "Badge: MR-Sync 2": sync_role,
+    }
+    assert registry.get(guild, "Badge: MR-Sync ") == {"Badge: MR-Sync 2": sync_role}
+
+
+def test_update_role_renames_key():
+    registry, guild = make_registry()
+    red = guild.add_role("Color: Red")
+    registry.get(guild, "Color: ")
+
+    registry.update_role(red, renamed(red, "Color: Crimson"))
+
+    assert set(registry.get(guild, "Color: ")) == {"crimson"}
+
+
+def test_update_role_moves_between_prefixes():
+    registry, guild = make_registry()
+    red = guild.add_role("Color: Red")
+    registry.get(guild, "Color: ")
+
+    badge = renamed(red, "Badge: Red")
+    registry.update_role(red, badge)
+    assert registry.get(guild, "Color: ") == {}
+    assert registry.get(guild, "Badge: ") == {"Badge: Red": badge}
+
+    registry.update_role(badge, renamed(badge, "Red"))
+    assert registry.get(guild, "Badge: ") == {}
+
+
+def test_update_role_keeps_other_role_with_old_name():
+    registry, guild = make_registry()
+    red = guild.add_role("Color: Red")
+    other_red = guild.add_role("Color: Red")
+    # The role built last wins the key.
+    assert registry.get(guild, "Color: ") == {"red": other_red}
+
+    registry.update_role(red, renamed(red, "Color: Crimson"))
+
+    assert registry.get(guild, "Color: ")["red"] is other_red
+
+
+def test_role_events_before_first_lookup_are_ignored():
+    registry, guild = make_registry()
+    red = guild.add_role("Color: Red")
+
+    # Nothing is built yet, so the first lookup builds from the guild.
+    registry.remove_role(red)
+
+    assert registry.get(guild, "Color: ") == {"red": red}
+
+
+def test_add_and_remove_role():
+    registry, guild = make_registry()
+    registry.get(guild, "Color: ")
+
+    blue = guild.add_role("Color: Blue")
+    registry.add_role(blue)
+    assert registry.get(guild, "Color: ") == {"blue": blue}
+
+    registry.remove_role(blue)
+    assert registry.get(guild, "Color: ") == {}
+
+
+def test_register_rebuilds_maps():
+    registry, guild = make_registry()
+    registry.get(guild, "Color: ")
+    she = guild.add_role("Pronouns: She/Her")
+
+    registry.register("Pronouns: ")
+
+    assert registry.get(guild, "Pronouns: ") == {"she/her": she}
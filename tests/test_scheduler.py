@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from ghist import scheduler
+from ghist.scheduler import MIDNIGHT_MARGIN, DailyTrigger, IntervalTrigger
+
+
+def test_interval_is_fixed_without_backoff():
+    trigger = IntervalTrigger(60)
+    assert [trigger.next_delay(changed) for changed in (True, False, None)] == [
+        60,
+        60,
+        60,
+    ]
+
+
+def test_interval_backs_off_until_something_changes():
+    trigger = IntervalTrigger(60, backoff=2, max_seconds=300)
+    delays = [trigger.next_delay(False) for _ in range(5)]
+    assert delays == [120, 240, 300, 300, 300]
+    assert trigger.next_delay(True) == 60
+
+
+def test_failed_runs_reset_the_backoff():
+    trigger = IntervalTrigger(60, backoff=2, max_seconds=300)
+    trigger.next_delay(False)
+    assert trigger.next_delay(None) == 60
+
+
+def test_interval_jitter_stays_in_bounds():
+    trigger = IntervalTrigger(100, jitter=0.1)
+    for _ in range(100):
+        assert 90 <= trigger.next_delay(True) <= 110
+
+
+class FakeDatetime(datetime):
+    now_value = None
+
+    @classmethod
+    def utcnow(cls):
+        return cls.now_value
+
+
+@pytest.fixture
+def utcnow(monkeypatch):
+    monkeypatch.setattr(scheduler, "datetime", FakeDatetime)
+
+    def set_now(value):
+        FakeDatetime.now_value = value
+
+    return set_now
+
+
+def test_daily_fires_after_next_midnight(utcnow):
+    utcnow(datetime(2022, 3, 1, 23, 59, 0))
+    assert DailyTrigger().next_delay(True) == 60 + MIDNIGHT_MARGIN
+
+
+def test_daily_fires_a_day_later_right_after_midnight(utcnow):
+    utcnow(datetime(2022, 12, 31, 0, 0, 1))
+    expected = timedelta(days=1, seconds=-1).total_seconds() + MIDNIGHT_MARGIN
+    assert DailyTrigger().next_delay(False) == expected
+
+
+def test_daily_retries_runs_that_did_not_complete(utcnow):
+    utcnow(datetime(2022, 3, 1, 0, 0, 1))
+    assert DailyTrigger(retry_delay=30).next_delay(None) == 30
@@ -0,0 +1,94 @@
+import asyncio
+
+from ghist.snapshot import Snapshot, SyncState, get_fingerprint
+
+
+def decode_titles(body):
+    return {int(member_id): title for member_id, title in body.items()}
+
+
+def test_store_payload_leaves_out_absent_members():
+    state = SyncState("scope")
+
+    state.store_payload({1: "a", 2: "b", 3: "c"}, {2}, 100.0)
+
+    assert state.payload == {1: "a", 3: "c"}
+    assert state.fetched_at == 100.0
+
+
+def test_store_payload_replaces_only_given_members():
+    state = SyncState("scope")
+    state.store_payload({1: "a", 2: "b", 3: "c"}, set(), 100.0)
+
+    state.store_payload({1: "x", 2: "y", 4: "z"}, {4}, 200.0, member_ids={1, 3, 4})
+
+    # 3 left the payload and 4 isn't in the guild.
+    assert state.payload == {1: "x", 2: "b"}
+    assert state.fetched_at == 200.0
+
+
+def test_close_waits_for_pending_saves(tmp_path):
+    path = tmp_path / "snapshot.db"
+    state = SyncState("scope")
+    state.store_payload({1: "a"}, set(), 100.0)
+    state.set_applied(1, {10})
+
+    async def save_and_close():
+        snapshot = Snapshot(str(path))
+        save = asyncio.ensure_future(snapshot.save(state, 1, {"1": "a"}))
+        await asyncio.sleep(0)
+        await snapshot.close()
+        await save
+
+    asyncio.run(save_and_close())
+
+    loaded = SyncState("scope")
+
+    async def load():
+        snapshot = Snapshot(str(path))
+        await snapshot.load(loaded, 1, decode_titles)
+        await snapshot.close()
+
+    asyncio.run(load())
+    assert loaded.payload == {1: "a"}
+    assert loaded.applied == {1: {10}}
+
+
+def test_fingerprint_survives_restarts(tmp_path):
+    path = str(tmp_path / "snapshot.db")
+    state = SyncState("scope")
+    state.store_payload({1: "a"}, set(), 100.0)
+    state.fingerprint = get_fingerprint(10, {"Badge": 11})
+
+    async def save():
+        snapshot = Snapshot(path)
+        await snapshot.save(state, 1, {"1": "a"})
+        await snapshot.close()
+
+    asyncio.run(save())
+
+    loaded = SyncState("scope")
+
+    async def load():
+        snapshot = Snapshot(path)
+        await snapshot.load(loaded, 1, decode_titles)
+        await snapshot.close()
+
+    asyncio.run(load())
+    assert loaded.fingerprint == state.fingerprint
+    assert loaded.payload == {1: "a"}
+
+
+def test_changed_fingerprint_plans_everyone():
+    state = SyncState("scope")
+    state.store_payload({1: "a", 2: "b"}, set(), 100.0)
+    state.set_applied(1, {10})
+    state.fingerprint = get_fingerprint(10)
+    held_roles = {1: frozenset({10}), 3: frozenset({10})}
+    payload = {1: "a", 2: "b"}
+
+    # Only member 3's roles changed since the last sync.
+    unchanged = state.get_members_to_plan(payload, held_roles, state.fingerprint, False)
+    assert unchanged == {3}
+    changed = state.get_members_to_plan(payload, held_roles, get_fingerprint(11), True)
+    assert changed == {1, 2, 3}
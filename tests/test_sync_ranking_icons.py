@@ -0,0 +1,111 @@
+import asyncio
+
+from bench.fakes import FakeBot, FakeGuild
+from ghist.cogs.sync_ranking_icons import MossRankingIconSync
+from ghist.mossranking import NotModified
+from ghist.role_applier import RoleChanges
+
+GUILD_ID = 1 << 40
+MEMBER_ID = 1 << 41
+SYNC_ROLE = "Badge: MR-Sync 2"
+COSMOS_ROLE = "Badge: 2 Cosmos"
+COSMOS_RANKING_ID = 20
+
+
+class FakeMossranking:
+    def __init__(self, titles):
+        self.titles = titles
+        self.not_modified = False
+
+    async def get_discord_user_ranking(self, ranking_id, discord_id, validators):
+        if self.not_modified:
+            raise NotModified
+        return {
+            str(member_id): title
+            for member_id, title in self.titles.get(ranking_id, {}).items()
+        }
+
+
+def make_bot(titles, has_sync_role=True):
+    bot = FakeBot(mossranking=FakeMossranking(titles))
+    guild = FakeGuild(GUILD_ID)
+    bot.add_guild(guild)
+    sync_role = guild.add_role(SYNC_ROLE)
+    guild.add_member(MEMBER_ID, {sync_role.id} if has_sync_role else set())
+    return bot, guild
+
+
+def add_role(bot, guild, name):
+    role = guild.add_role(name)
+    bot.role_registry.add_role(role)
+    return role
+
+
+def run_syncs(not_modified):
+    async def run():
+        bot, guild = make_bot({COSMOS_RANKING_ID: {MEMBER_ID: "Cosmos Explorer"}})
+        icon_sync = MossRankingIconSync(bot=bot, guild_ids=[GUILD_ID])
+        try:
+            await icon_sync.sync_role_icons()
+            assert guild.recorder.edits == 0
+
+            bot.mossranking.not_modified = not_modified
+            cosmos_role = add_role(bot, guild, COSMOS_ROLE)
+            await icon_sync.sync_role_icons()
+            return guild.get_member(MEMBER_ID).get_role(cosmos_role.id)
+        finally:
+            icon_sync.cog_unload()
+
+    return asyncio.run(run())
+
+
+def test_badge_role_created_later_is_granted():
+    assert run_syncs(not_modified=False) is not None
+
+
+def test_badge_role_created_later_is_granted_when_titles_are_unchanged():
+    assert run_syncs(not_modified=True) is not None
+
+
+def run_merged_sync(has_sync_role, queue):
+    """Reconcile badges on top of changes queued by `queue` and apply both."""
+
+    async def run():
+        bot, guild = make_bot(
+            {COSMOS_RANKING_ID: {MEMBER_ID: "Cosmos Explorer"}}, has_sync_role
+        )
+        cosmos_role = add_role(bot, guild, COSMOS_ROLE)
+        member = guild.get_member(MEMBER_ID)
+        if has_sync_role:
+            await member.edit(roles=[*member.roles[1:], cosmos_role])
+            guild.recorder.reset()
+        sync_role = next(role for role in guild.roles if role.name == SYNC_ROLE)
+        icon_sync = MossRankingIconSync(bot=bot, guild_ids=[GUILD_ID])
+        try:
+            changes = RoleChanges()
+            queue(changes, member, sync_role)
+            changes_by_guild = {GUILD_ID: changes}
+            finish = await icon_sync.reconcile(changes_by_guild)
+            await bot.role_applier.apply_all(
+                changes_by_guild, source="test", reason="test"
+            )
+            await finish()
+            member = guild.get_member(MEMBER_ID)
+            has_badge = member.get_role(cosmos_role.id) is not None
+            return has_badge, guild.recorder.edits
+        finally:
+            icon_sync.cog_unload()
+
+    return asyncio.run(run())
+
+
+def test_badge_is_planned_on_top_of_a_queued_sync_role():
+    has_badge, edits = run_merged_sync(False, RoleChanges.add)
+    assert has_badge
+    assert edits == 1
+
+
+def test_badge_is_removed_along_with_a_queued_sync_role_removal():
+    has_badge, edits = run_merged_sync(True, RoleChanges.remove)
+    assert not has_badge
+    assert edits == 1
@@ -0,0 +1,55 @@
+import random
+
+from ghist.cogs.sync_ranking_icons import Ranking, TitleMatcher
+
+RANKINGS = [
+    Ranking(contains=["Grand Champion", "Champion"], role="Badge: Champion"),
+    Ranking(contains="Expert", role="Badge: Expert"),
+    Ranking(contains=["Speedrunner", "Runner (.*)"], role="Badge: Runner"),
+]
+
+
+def match_substrings(rankings, title):
+    # The matching the pattern replaced.
+    for ranking in rankings:
+        for needle in ranking.needles:
+            if needle in title:
+                return ranking
+    return None
+
+
+def test_first_listed_ranking_wins():
+    matcher = TitleMatcher(RANKINGS)
+    assert matcher.match("Expert Champion").role == "Badge: Champion"
+    assert matcher.match("Speedrunner Expert").role == "Badge: Expert"
+
+
+def test_needles_are_literal():
+    matcher = TitleMatcher(RANKINGS)
+    assert matcher.match("Runner (.*) of the year").role == "Badge: Runner"
+    assert matcher.match("Runner of the year") is None
+
+
+def test_no_match():
+    assert TitleMatcher(RANKINGS).match("Novice") is None
+    assert TitleMatcher(RANKINGS).match("") is None
+
+
+def test_multiline_titles():
+    assert TitleMatcher(RANKINGS).match("New\nExpert").role == "Badge: Expert"
+
+
+def test_cached_results_stay_correct():
+    matcher = TitleMatcher(RANKINGS)
+    for _ in range(3):
+        assert matcher.match("Expert").role == "Badge: Expert"
+        assert matcher.match("Novice") is None
+
+
+def test_matches_substring_search():
+    words = ["Grand", "Champion", "Expert", "Speedrunner", "Runner", "(.*)", "x"]
+    rng = random.Random(0)
+    matcher = TitleMatcher(RANKINGS)
+    for _ in range(1000):
+        title = " ".join(rng.choice(words) for _ in range(rng.randrange(4)))
+        assert matcher.match(title) is match_substrings(RANKINGS, title)